@@ -5,8 +5,10 @@ from fastapi.middleware.cors import CORSMiddleware
 import cv2
 import numpy as np
 from yomitoku import DocumentAnalyzer
+from yomitoku.serving import BatchingDocumentAnalyzer
 import json
 import logging
+import os
 
 # ロガーの設定
 logging.basicConfig(level=logging.INFO)
@@ -51,14 +53,26 @@ analyzer = DocumentAnalyzer(
         },
     },
     device="cuda",
-    visualize=False
+    visualize=False,
 )
 logger.info("DocumentAnalyzer initialization completed!")
 
+# 同時に受け付けたリクエストのページを、モデルごとにまとめてバッチ推論する
+batcher = BatchingDocumentAnalyzer(
+    analyzer,
+    max_batch_size=int(os.environ.get("YOMITOKU_MAX_BATCH_SIZE", "8")),
+    max_wait_ms=float(os.environ.get("YOMITOKU_MAX_WAIT_MS", "10")),
+)
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("FastAPI server is ready to handle requests!")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await batcher.close()
+    analyzer.close()
+
 @app.post("/analyze")
 async def analyze_document(
     file: UploadFile = File(...),
@@ -75,7 +89,6 @@ async def analyze_document(
     """
     # ファイルを一時保存
     import tempfile
-    import os
 
     with tempfile.NamedTemporaryFile(delete=False, suffix=file.filename) as temp_file:
         contents = await file.read()
@@ -91,10 +104,7 @@ async def analyze_document(
             nparr = np.frombuffer(contents, np.uint8)
             imgs = [cv2.imdecode(nparr, cv2.IMREAD_COLOR)]
 
-        all_results = []
-        for img in imgs:
-            results, _, _ = await analyzer(img)
-            all_results.append(results)
+        all_results = await batcher.analyze_pages(imgs)
 
         # フォーマットに応じて結果を返す
         format = format.lower()
@@ -1,3 +1,5 @@
+import inspect
+import threading
 import time
 from pathlib import Path
 from typing import Union
@@ -37,6 +39,10 @@ def load_config(
 
 
 def observer(cls, func):
+    # インスタンスを生成するたびに重ねて計測しないよう、計測済みの関数はそのまま返す
+    if getattr(func, "_observed", False):
+        return func
+
     def wrapper(*args, **kwargs):
         try:
             start = time.time()
@@ -48,6 +54,7 @@ def observer(cls, func):
             raise e
         return result
 
+    wrapper._observed = True
     return wrapper
 
 
@@ -78,15 +85,27 @@ class BaseModule:
     def __new__(cls, *args, **kwds):
         logger.info(f"Initialize {cls.__name__}")
         cls.__call__ = observer(cls, cls.__call__)
+        if hasattr(cls, "run_batch"):
+            cls.run_batch = observer(cls, cls.run_batch)
         return super().__new__(cls)
 
-    def load_model(self, name, path_cfg, from_pretrained=True):
-        default_cfg, Net = self.model_catalog.get(name)
-        self._cfg = load_config(default_cfg, path_cfg)
+    @classmethod
+    def build_config(cls, name, path_cfg=None):
+        default_cfg, _ = cls.model_catalog.get(name)
+        return load_config(default_cfg, path_cfg)
+
+    @classmethod
+    def build_model(cls, name, path_cfg=None, from_pretrained=True):
+        _, Net = cls.model_catalog.get(name)
+        cfg = cls.build_config(name, path_cfg)
         if from_pretrained:
-            self.model = Net.from_pretrained(self._cfg.hf_hub_repo, cfg=self._cfg)
+            model = Net.from_pretrained(cfg.hf_hub_repo, cfg=cfg)
         else:
-            self.model = Net(cfg=self._cfg)
+            model = Net(cfg=cfg)
+        return cfg, model
+
+    def load_model(self, name, path_cfg, from_pretrained=True):
+        self._cfg, self.model = self.build_model(name, path_cfg, from_pretrained)
 
     def save_config(self, path_cfg):
         OmegaConf.save(self._cfg, path_cfg)
@@ -94,6 +113,9 @@ class BaseModule:
     def log_config(self):
         logger.info(OmegaConf.to_yaml(self._cfg))
 
+    def dump_config(self):
+        return OmegaConf.to_yaml(self._cfg)
+
     @classmethod
     def catalog(cls):
         display = ""
@@ -123,6 +145,51 @@ class BaseModule:
             self._device = torch.device("cpu")
 
 
+class LazyModule:
+    """
+    Thread-safe holder that instantiates a module on first access.
+    The config is resolved immediately so that invalid configs are reported at initialization.
+
+    Args:
+        cls (type): class of the module
+        lazy (bool, optional): if False, the module is instantiated immediately. Defaults to True.
+        **kwargs: arguments passed to the module
+    """
+
+    def __init__(self, cls, lazy=True, **kwargs):
+        self.cls = cls
+        self.kwargs = kwargs
+        self._module = None
+        self._lock = threading.Lock()
+
+        if lazy:
+            # モデルを読み込まずに設定のみを解決する
+            params = inspect.signature(cls.__init__).parameters
+            name = kwargs.get("model_name", params["model_name"].default)
+            self._cfg = cls.build_config(name, kwargs.get("path_cfg"))
+        else:
+            self._cfg = self.get()._cfg
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def get(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = self.cls(**self.kwargs)
+        return self._module
+
+    def dump_config(self):
+        return OmegaConf.to_yaml(self._cfg)
+
+    def cache_config(self):
+        # ONNXでの推論結果はPyTorchと完全には一致しないため、推論方法もキャッシュのキーに含める
+        infer_onnx = self.kwargs.get("infer_onnx", False)
+        return f"{self.dump_config()}infer_onnx: {infer_onnx}\n"
+
+
 class BaseModelCatalog:
     def __init__(self):
         self.catalog = {}
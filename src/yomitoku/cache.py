@@ -0,0 +1,284 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+from filelock import FileLock
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache bounded by the number of entries."""
+
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.max_items <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RecognitionMemo:
+    """
+    Bounded in-memory cache of text recognition results keyed by the word images.
+
+    The word images normalized to [-1, 1] are quantized to 8 bits before hashing,
+    so identical crops of repeated text (headers, footers, column titles) hit the cache
+    while any difference in the quantized pixels is a miss.
+
+    Args:
+        max_items (int, optional): maximum number of results kept in memory. Defaults to 4096.
+    """
+
+    def __init__(self, max_items=4096):
+        self.memory = LRUCache(max_items)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.memory)
+
+    @staticmethod
+    def make_keys(images, namespace=""):
+        """
+        Args:
+            images (torch.Tensor): (N, C, H, W) word images normalized to [-1, 1]
+            namespace (str, optional): settings of the recognition that change the results. Defaults to "".
+
+        Returns:
+            list[str]: key of each word image
+        """
+
+        # デバイス上で8bitに量子化してから転送する
+        quantized = ((images + 1) * 127.5).round().clamp(0, 255).to(torch.uint8)
+        quantized = quantized.cpu().numpy()
+
+        keys = []
+        for image in quantized:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(f"{namespace}:{image.shape}".encode())
+            h.update(image.data)
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None:
+            self.count(misses=1)
+        else:
+            self.count(hits=1)
+        return value
+
+    def count(self, hits=0, misses=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "items": len(self)}
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+class DiskCache:
+    """
+    Size-bounded on-disk store. The least recently used files are evicted first.
+
+    Several processes may share the directory. The total size of the store is kept in
+    the directory and updated under a file lock, and the directory is rescanned under
+    the lock before evicting, so the bound holds for all processes together.
+    """
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(self.cache_dir / ".lock")
+        self._size_path = self.cache_dir / ".size"
+        self._clock_lock = threading.Lock()
+        self._last_access = 0
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def _touch(self, path):
+        # 最終アクセス時刻(mtime)をLRUの順序とする。同一プロセス内では時刻が重複しないようにする
+        with self._clock_lock:
+            self._last_access = max(time.time_ns(), self._last_access + 1)
+            access = self._last_access
+        os.utime(path, ns=(access, access))
+
+    def _scan(self):
+        files = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, path, stat.st_size))
+        files.sort(key=lambda x: x[0])
+        return files
+
+    def _read_size(self):
+        try:
+            return int(self._size_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return sum(size for _, _, size in self._scan())
+
+    def _evict(self):
+        files = self._scan()
+        total = sum(size for _, _, size in files)
+        for _, path, size in files[:-1]:
+            if total <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            data = path.read_text(encoding="utf-8")
+            self._touch(path)
+        except FileNotFoundError:
+            # 他のプロセスに削除された場合を含む
+            return None
+
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(data, encoding="utf-8")
+
+        with self._lock, self._file_lock:
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+
+            os.replace(tmp_path, path)
+            self._touch(path)
+
+            size = self._read_size() + path.stat().st_size - old_size
+            if size > self.max_size:
+                size = self._evict()
+            self._size_path.write_text(str(size))
+
+
+class ResultCache:
+    """
+    Content-addressed cache of analysis results.
+
+    Results are stored as serialized JSON, keyed by a hash of the decoded image pixels
+    and the effective configs of the modules that produced them. An in-memory LRU tier
+    is checked first, then an optional on-disk store.
+
+    Args:
+        cache_dir (str, optional): directory of the on-disk store. If None, only the in-memory tier is used. Defaults to None.
+        max_disk_size (int, optional): maximum total size in bytes of the on-disk store. Defaults to 1GiB.
+        max_memory_items (int, optional): maximum number of results kept in memory. Defaults to 256.
+    """
+
+    def __init__(self, cache_dir=None, max_disk_size=1 << 30, max_memory_items=256):
+        self.memory = LRUCache(max_memory_items)
+        self.disk = None
+        if cache_dir is not None:
+            self.disk = DiskCache(cache_dir, max_size=max_disk_size)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest_configs(configs):
+        """
+        Args:
+            configs (list[str]): serialized configs of the modules in the pipeline
+
+        Returns:
+            str: digest of the configs, which is passed to make_key
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for config in configs:
+            h.update(config.encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def make_key(img, namespace, configs):
+        """
+        Args:
+            img (np.ndarray): decoded image
+            namespace (str): name of the pipeline that produces the results
+            configs (list[str]): serialized configs of the modules in the pipeline
+        """
+        img = np.ascontiguousarray(img)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{namespace}:{img.shape}:{img.dtype}".encode())
+        h.update(img.data)
+        for config in configs:
+            h.update(config.encode())
+        return h.hexdigest()
+
+    def get(self, key, schema):
+        data = self.memory.get(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.memory.put(key, data)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if data is None:
+            return None
+        return schema.model_validate_json(data)
+
+    def put(self, key, results):
+        data = results.model_dump_json()
+        self.memory.put(key, data)
+        if self.disk is not None:
+            self.disk.put(key, data)
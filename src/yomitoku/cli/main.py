@@ -1,13 +1,19 @@
 import argparse
 import asyncio
+import json
+import multiprocessing
+import multiprocessing.util
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import cv2
 import time
+import torch
 
+from ..cache import ResultCache
 from ..constants import SUPPORT_OUTPUT_FORMAT
-from ..data.functions import load_image, load_pdf
+from ..data.functions import load_image
 from ..document_analyzer import DocumentAnalyzer
 from ..utils.logger import set_logger
 
@@ -16,66 +22,183 @@ logger = set_logger(__name__, "INFO")
 
 async def process_single_file(args, analyzer, path, format):
     if path.suffix[1:].lower() in ["pdf"]:
-        imgs = load_pdf(path)
+        # ページの描画・推論・出力をパイプラインで並行して実行する
+        pages = analyzer.stream(path, batch_size=args.batch_size)
+        page = 0
+        async for img, results, ocr, layout in pages:
+            await asyncio.to_thread(
+                save_results, args, path, page, img, results, ocr, layout, format
+            )
+            page += 1
     else:
-        imgs = [load_image(path)]
-
-    for page, img in enumerate(imgs):
+        img = load_image(path)
         results, ocr, layout = await analyzer(img)
+        save_results(args, path, 0, img, results, ocr, layout, format)
 
-        dirname = path.parent.name
-        filename = path.stem
 
-        if ocr is not None:
-            out_path = os.path.join(
-                args.outdir, f"{dirname}_{filename}_p{page+1}_ocr.jpg"
-            )
+def save_results(args, path, page, img, results, ocr, layout, format):
+    dirname = path.parent.name
+    filename = path.stem
 
-            cv2.imwrite(out_path, ocr)
-            logger.info(f"Output file: {out_path}")
+    if ocr is not None:
+        out_path = os.path.join(
+            args.outdir, f"{dirname}_{filename}_p{page+1}_ocr.jpg"
+        )
 
-        if layout is not None:
-            out_path = os.path.join(
-                args.outdir, f"{dirname}_{filename}_p{page+1}_layout.jpg"
-            )
+        cv2.imwrite(out_path, ocr)
+        logger.info(f"Output file: {out_path}")
 
-            cv2.imwrite(out_path, layout)
-            logger.info(f"Output file: {out_path}")
+    if layout is not None:
+        out_path = os.path.join(
+            args.outdir, f"{dirname}_{filename}_p{page+1}_layout.jpg"
+        )
 
-        out_path = os.path.join(args.outdir, f"{dirname}_{filename}_p{page+1}.{format}")
+        cv2.imwrite(out_path, layout)
+        logger.info(f"Output file: {out_path}")
 
-        if format == "json":
-            results.to_json(
-                out_path,
-                ignore_line_break=args.ignore_line_break,
-            )
-        elif format == "csv":
-            results.to_csv(
-                out_path,
-                ignore_line_break=args.ignore_line_break,
-            )
-        elif format == "html":
-            results.to_html(
-                out_path,
-                ignore_line_break=args.ignore_line_break,
-                img=img,
-                export_figure=args.figure,
-                export_figure_letter=args.figure_letter,
-                figure_width=args.figure_width,
-                figure_dir=args.figure_dir,
-            )
-        elif format == "md":
-            results.to_markdown(
-                out_path,
-                ignore_line_break=args.ignore_line_break,
-                img=img,
-                export_figure=args.figure,
-                export_figure_letter=args.figure_letter,
-                figure_width=args.figure_width,
-                figure_dir=args.figure_dir,
-            )
+    out_path = os.path.join(args.outdir, f"{dirname}_{filename}_p{page+1}.{format}")
 
-        logger.info(f"Output file: {out_path}")
+    if format == "json":
+        results.to_json(
+            out_path,
+            ignore_line_break=args.ignore_line_break,
+        )
+    elif format == "csv":
+        results.to_csv(
+            out_path,
+            ignore_line_break=args.ignore_line_break,
+        )
+    elif format == "html":
+        results.to_html(
+            out_path,
+            ignore_line_break=args.ignore_line_break,
+            img=img,
+            export_figure=args.figure,
+            export_figure_letter=args.figure_letter,
+            figure_width=args.figure_width,
+            figure_dir=args.figure_dir,
+        )
+    elif format == "md":
+        results.to_markdown(
+            out_path,
+            ignore_line_break=args.ignore_line_break,
+            img=img,
+            export_figure=args.figure,
+            export_figure_letter=args.figure_letter,
+            figure_width=args.figure_width,
+            figure_dir=args.figure_dir,
+        )
+
+    logger.info(f"Output file: {out_path}")
+
+
+async def process_directory(args, analyzer, files, format):
+    failures = []
+    for file_path in files:
+        try:
+            start = time.time()
+            logger.info(f"Processing file: {file_path}")
+            await process_single_file(args, analyzer, file_path, format)
+            end = time.time()
+            logger.info(f"Total Processing time: {end-start:.2f} sec")
+        except Exception as e:
+            failures.append(report_failure(file_path, e))
+
+    return failures
+
+
+# ワーカープロセスごとに一度だけモデルを読み込み、プロセス内で使い回す
+_worker_analyzer = None
+
+
+def init_worker(args, configs, num_threads):
+    global _worker_analyzer
+    torch.set_num_threads(num_threads)
+    _worker_analyzer = build_analyzer(args, configs)
+
+    # ワーカープロセスはatexitを実行せずに終了するため、終了処理としてスレッドプールを閉じる
+    multiprocessing.util.Finalize(
+        _worker_analyzer, _worker_analyzer.close, exitpriority=10
+    )
+
+
+def build_analyzer(args, configs):
+    # 使用されないモデルを読み込まないように、各モデルは初めて使用される時に読み込む
+    return DocumentAnalyzer(
+        configs=configs,
+        visualize=args.vis,
+        device=args.device,
+        cache=build_cache(args),
+        lazy=True,
+        enable_layout=not args.disable_layout,
+        enable_table=not args.disable_table,
+    )
+
+
+def build_cache(args):
+    if args.cache_dir is None:
+        return None
+
+    return ResultCache(
+        cache_dir=args.cache_dir,
+        max_disk_size=args.cache_size * 1024 * 1024,
+    )
+
+
+def process_file_in_worker(args, file_path, format):
+    start = time.time()
+    logger.info(f"Processing file: {file_path}")
+    asyncio.run(process_single_file(args, _worker_analyzer, file_path, format))
+    end = time.time()
+    logger.info(f"Total Processing time: {end-start:.2f} sec")
+
+
+def process_directory_in_workers(args, configs, files, format):
+    # CUDAの初期化済みプロセスをforkできないため、spawnでワーカーを起動する
+    num_threads = max(1, os.cpu_count() // args.workers)
+    failures = []
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args, configs, num_threads),
+    ) as executor:
+        futures = {
+            executor.submit(process_file_in_worker, args, file_path, format): file_path
+            for file_path in files
+        }
+
+        for future in as_completed(futures):
+            # ワーカーが異常終了した場合も、完了していないファイルは
+            # BrokenProcessPoolにより失敗として記録され、報告が出力される
+            try:
+                future.result()
+            except Exception as e:
+                failures.append(report_failure(futures[future], e))
+
+    return failures
+
+
+def report_failure(file_path, e):
+    logger.error(f"Failed to process file: {file_path}: {e}")
+    return {"file": str(file_path), "error": f"{type(e).__name__}: {e}"}
+
+
+def save_report(outdir, files, failures):
+    failed_files = [failure["file"] for failure in failures]
+    report = {
+        "succeeded": [str(f) for f in files if str(f) not in failed_files],
+        "failed": sorted(failures, key=lambda x: x["file"]),
+    }
+
+    out_path = os.path.join(outdir, "report.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+    logger.info(
+        f"Processed {len(files)} files: {len(report['succeeded'])} succeeded, {len(failures)} failed"
+    )
+    logger.info(f"Report file: {out_path}")
 
 
 async def async_main():
@@ -163,6 +286,40 @@ async def async_main():
         default=200,
         help="width of figure image in the output",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="number of PDF pages analyzed together",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to process a directory",
+    )
+    parser.add_argument(
+        "--disable_layout",
+        action="store_true",
+        help="if set, skip layout analysis and table recognition, and output the OCR results only",
+    )
+    parser.add_argument(
+        "--disable_table",
+        action="store_true",
+        help="if set, skip table structure recognition",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache the analysis results. Pages already analyzed with the same configs are not analyzed again",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=1024,
+        help="maximum size of the cache directory in MB",
+    )
     parser.add_argument(
         "--figure_dir",
         type=str,
@@ -224,32 +381,24 @@ async def async_main():
         # configs["layout_analyzer"]["table_structure_recognizer"]["infer_onnx"] = True
         # configs["layout_analyzer"]["layout_parser"]["infer_onnx"] = True
 
-    analyzer = DocumentAnalyzer(
-        configs=configs,
-        visualize=args.vis,
-        device=args.device,
-    )
-
     os.makedirs(args.outdir, exist_ok=True)
     logger.info(f"Output directory: {args.outdir}")
 
     if path.is_dir():
         all_files = [f for f in path.rglob("*") if f.is_file()]
-        for f in all_files:
-            try:
-                start = time.time()
-                file_path = Path(f)
-                logger.info(f"Processing file: {file_path}")
-                await process_single_file(args, analyzer, file_path, format)
-                end = time.time()
-                logger.info(f"Total Processing time: {end-start:.2f} sec")
-            except Exception:
-                continue
+        if args.workers > 1:
+            failures = process_directory_in_workers(args, configs, all_files, format)
+        else:
+            with build_analyzer(args, configs) as analyzer:
+                failures = await process_directory(args, analyzer, all_files, format)
+
+        save_report(args.outdir, all_files, failures)
     else:
-        start = time.time()
-        logger.info(f"Processing file: {path}")
-        await process_single_file(args, analyzer, path, format)
-        end = time.time()
+        with build_analyzer(args, configs) as analyzer:
+            start = time.time()
+            logger.info(f"Processing file: {path}")
+            await process_single_file(args, analyzer, path, format)
+            end = time.time()
         logger.info(f"Total Processing time: {end-start:.2f} sec")
 
 
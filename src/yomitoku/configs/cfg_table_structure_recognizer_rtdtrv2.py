@@ -5,6 +5,7 @@ from typing import List
 @dataclass
 class Data:
     img_size: List[int] = field(default_factory=lambda: [640, 640])
+    batch_size: int = 8
 
 
 @dataclass
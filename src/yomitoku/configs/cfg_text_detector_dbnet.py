@@ -22,6 +22,21 @@ class Decoder:
 class Data:
     shortest_size: int = 1280
     limit_size: int = 1600
+    batch_size: int = 4
+    # バッチ推論時に各辺をこの値の倍数に切り上げてパディングする(0の場合は無効)
+    bucket_stride: int = 128
+    # 長辺がlimit_sizeを超えるページをこのサイズのタイルに分割して検出する(0の場合は無効)
+    tile_size: int = 0
+    # 隣接するタイル同士の重なり幅
+    tile_overlap: int = 128
+    # タイル分割前に元画像に掛ける倍率
+    tile_scale: float = 1.0
+    # Trueの場合、低解像度での検出結果から推定した文字の高さに応じてページごとに解像度を決める
+    adaptive: bool = False
+    # 文字の高さを推定するための粗い推論での短辺の長さ
+    adaptive_coarse_size: int = 640
+    # 検出時の文字の高さの目標値(ピクセル)
+    adaptive_text_height: int = 24
 
 
 @dataclass
@@ -31,6 +46,8 @@ class PostProcess:
     box_thresh: float = 0.5
     max_candidates: int = 1500
     unclip_ratio: float = 7.0
+    # Trueの場合、全候補を配列演算でまとめて後処理する
+    vectorized: bool = False
 
 
 @dataclass
@@ -6,9 +6,14 @@ from ..constants import ROOT_DIR
 
 @dataclass
 class Data:
+    # 文字画像の切り出しに用いるスレッド数(0の場合は呼び出し元のスレッドで処理する)
     num_workers: int = 4
     batch_size: int = 128
     img_size: List[int] = field(default_factory=lambda: [32, 800])
+    # Trueの場合、ページ全体をテンソルに変換し、全ての文字画像をgrid_sampleでまとめて切り出す
+    batched_crop: bool = False
+    # 空でない場合、文字画像をリサイズ後の幅で分類し、各グループを分類先の幅で認識する(例: [128, 256, 512, 800])
+    width_buckets: List[int] = field(default_factory=list)
 
 
 @dataclass
@@ -28,6 +33,24 @@ class Decoder:
     depth: int = 1
 
 
+@dataclass
+class Hybrid:
+    # Trueの場合、非自己回帰の推論と精緻化で全ての文字画像を認識し、
+    # 確信度の低い文字画像と精緻化で結果が変わった文字画像のみを自己回帰で認識し直す
+    enabled: bool = False
+    # 各トークンの確率の最小値がこの値未満の場合、自己回帰で認識し直す
+    thresh: float = 0.9
+
+
+@dataclass
+class Cascade:
+    # 空でない場合、認識スコアがthresh未満の文字画像をこのモデルで再度認識する(例: "parseq")
+    model_name: str = ""
+    # 再認識に用いるモデルの設定ファイル(空の場合は既定の設定を用いる)
+    path_cfg: str = ""
+    thresh: float = 0.8
+
+
 @dataclass
 class Visualize:
     font: str = str(ROOT_DIR + "/resource/MPLUS1p-Medium.ttf")
@@ -43,9 +66,13 @@ class TextRecognizerPARSeqSmallConfig:
     max_label_length: int = 100
     decode_ar: int = 1
     refine_iters: int = 1
+    # 0より大きい場合、同じ文字画像の認識結果を最大この件数までメモリに保持して再利用する
+    memo_size: int = 0
 
     data: Data = field(default_factory=Data)
     encoder: Encoder = field(default_factory=Encoder)
     decoder: Decoder = field(default_factory=Decoder)
+    hybrid: Hybrid = field(default_factory=Hybrid)
+    cascade: Cascade = field(default_factory=Cascade)
 
     visualize: Visualize = field(default_factory=Visualize)
@@ -60,15 +60,15 @@ def load_image(image_path: str) -> np.ndarray:
     return img
 
 
-def load_pdf(pdf_path: str, dpi=200) -> list[np.ndarray]:
+def iter_pdf(pdf_path: str, dpi=200):
     """
-    Open a PDF file.
+    Open a PDF file and render the pages one by one.
 
     Args:
         pdf_path (str): path to the PDF file
 
-    Returns:
-        list[np.ndarray]: list of image data(BGR)
+    Yields:
+        np.ndarray: image data(BGR)
     """
 
     pdf_path = Path(pdf_path)
@@ -88,18 +88,33 @@ def load_pdf(pdf_path: str, dpi=200) -> list[np.ndarray]:
 
     try:
         doc = pypdfium2.PdfDocument(pdf_path)
-        renderer = doc.render(
-            pypdfium2.PdfBitmap.to_pil,
-            scale=dpi / 72,
-        )
-        images = list(renderer)
-        images = [np.array(image.convert("RGB"))[:, :, ::-1] for image in images]
-
-        doc.close()
     except Exception as e:
         raise ValueError(f"Failed to open the PDF file: {pdf_path}") from e
 
-    return images
+    try:
+        for i in range(len(doc)):
+            try:
+                image = doc[i].render(scale=dpi / 72).to_pil()
+            except Exception as e:
+                raise ValueError(f"Failed to open the PDF file: {pdf_path}") from e
+
+            yield np.array(image.convert("RGB"))[:, :, ::-1]
+    finally:
+        doc.close()
+
+
+def load_pdf(pdf_path: str, dpi=200) -> list[np.ndarray]:
+    """
+    Open a PDF file.
+
+    Args:
+        pdf_path (str): path to the PDF file
+
+    Returns:
+        list[np.ndarray]: list of image data(BGR)
+    """
+
+    return list(iter_pdf(pdf_path, dpi=dpi))
 
 
 def resize_shortest_edge(
@@ -173,6 +188,57 @@ def array_to_tensor(img: np.ndarray) -> torch.Tensor:
     return tensor
 
 
+def bucket_shape(h: int, w: int, stride: int, max_length: int) -> tuple[int, int]:
+    """
+    Round the image size up to a canonical bucket size, so that images of similar sizes share the same padded shape.
+    Each edge is rounded up to a multiple of `stride`, but not beyond `max_length` (rounded down to a multiple of 32).
+
+    Args:
+        h (int): height of the image
+        w (int): width of the image
+        stride (int): step of the bucket sizes. If 0, the size is returned as it is.
+        max_length (int): pixel length of maximum edge
+
+    Returns:
+        tuple[int, int]: height and width of the bucket
+    """
+
+    if stride <= 0:
+        return h, w
+
+    limit = max(max_length // 32 * 32, 32)
+
+    def _round_up(x):
+        return max(x, min(-(-x // stride) * stride, limit))
+
+    return _round_up(h), _round_up(w)
+
+
+def tile_positions(length: int, tile_size: int, overlap: int) -> list[int]:
+    """
+    Start positions of the tiles that cover `length` pixels with the tiles of `tile_size` pixels
+    overlapping each other by at least `overlap` pixels.
+
+    Args:
+        length (int): pixel length of the edge to cover
+        tile_size (int): pixel length of the tile
+        overlap (int): minimum overlap between neighboring tiles
+
+    Returns:
+        list[int]: start positions of the tiles
+    """
+
+    if tile_size <= overlap:
+        raise ValueError("tile_size must be greater than overlap.")
+
+    if length <= tile_size:
+        return [0]
+
+    positions = list(range(0, length - tile_size, tile_size - overlap))
+    positions.append(length - tile_size)
+    return positions
+
+
 def validate_quads(img: np.ndarray, quads: list[list[list[int]]]):
     """
     Validate the vertices of the quadrilateral.
@@ -284,3 +350,191 @@ def resize_with_padding(img, target_size, background_color=(0, 0, 0)):
     canvas[: resized_size[0], : resized_size[1], :] = resized
 
     return canvas
+
+
+def resized_text_widths(quads, target_size, thresh_aspect=2):
+    """
+    Compute the width of each word image after `extract_roi_with_perspective`,
+    `rotate_text_image` and `resize_with_padding`, without extracting the images.
+
+    Args:
+        quads (list): quadrilaterals of the words
+        target_size (int, int): target size of `resize_with_padding`
+        thresh_aspect (int): threshold of aspect ratio to rotate the word image
+
+    Returns:
+        np.ndarray: (N,) widths of the resized word images
+    """
+
+    quads = np.array(quads, dtype=np.float32).reshape(-1, 4, 2)
+    width = np.linalg.norm(quads[:, 0] - quads[:, 1], axis=1).astype(np.int64)
+    height = np.linalg.norm(quads[:, 1] - quads[:, 2], axis=1).astype(np.int64)
+
+    # 縦長の画像は回転後の幅を用いる
+    rotate = height > thresh_aspect * width
+    width, height = np.where(rotate, height, width), np.where(rotate, width, height)
+
+    scale_w = np.where(
+        width > target_size[1], target_size[1] / np.maximum(width, 1), 1.0
+    )
+    scale_h = np.where(
+        height > target_size[0], target_size[0] / np.maximum(height, 1), 1.0
+    )
+    return (width * np.minimum(scale_w, scale_h)).astype(np.int64)
+
+
+def perspective_transforms(src: torch.Tensor, dst: torch.Tensor) -> torch.Tensor:
+    """
+    Compute the perspective transforms that map the points `src` to the points `dst` at once.
+    This is a batched version of `cv2.getPerspectiveTransform`.
+
+    Args:
+        src (torch.Tensor): (N, 4, 2) source points
+        dst (torch.Tensor): (N, 4, 2) destination points
+
+    Returns:
+        torch.Tensor: (N, 3, 3) transformation matrices
+    """
+
+    n = src.shape[0]
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    ones = torch.ones_like(x)
+    zeros = torch.zeros_like(x)
+
+    rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], dim=-1)
+    rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], dim=-1)
+    A = torch.cat([rows_u, rows_v], dim=1)
+    b = torch.cat([u, v], dim=1)
+
+    h = torch.linalg.solve(A, b)
+    h = torch.cat([h, torch.ones(n, 1, dtype=h.dtype, device=h.device)], dim=1)
+    return h.view(n, 3, 3)
+
+
+def extract_rois_with_grid_sample(
+    page: torch.Tensor, quads, target_size, thresh_aspect=2
+) -> torch.Tensor:
+    """
+    Extract the word images from the page tensor at once and build the normalized recognizer input.
+    This is equivalent to `extract_roi_with_perspective`, `rotate_text_image`, `resize_with_padding`
+    and the normalization applied to each word, but the perspective transformation, the rotation of
+    vertical text and the resizing are composed into a single transform per word and sampled
+    with bilinear interpolation by `grid_sample`.
+
+    Args:
+        page (torch.Tensor): (1, C, H, W) page tensor with pixel values in [0, 255]
+        quads (list): quadrilaterals of the words
+        target_size (int, int): (height, width) of the word images
+        thresh_aspect (int): threshold of aspect ratio to rotate the word image
+
+    Returns:
+        torch.Tensor: (N, C, height, width) word images normalized to [-1, 1]
+    """
+
+    device = page.device
+    target_h, target_w = target_size
+    _, channels, page_h, page_w = page.shape
+
+    # MPSはfloat64に対応しないため、変換行列はCPU上で倍精度で求めてからデバイスに転送する
+    quads = torch.from_numpy(np.array(quads, dtype=np.float64))
+    n = quads.shape[0]
+    if n == 0:
+        return torch.empty(0, channels, target_h, target_w, device=device)
+
+    width = torch.linalg.norm(quads[:, 0] - quads[:, 1], dim=1).floor().clamp(min=1)
+    height = torch.linalg.norm(quads[:, 1] - quads[:, 2], dim=1).floor().clamp(min=1)
+
+    # 切り出した画像の座標系から元画像の座標系への射影変換
+    zeros = torch.zeros_like(width)
+    rect = torch.stack(
+        [
+            torch.stack([zeros, zeros], dim=1),
+            torch.stack([width, zeros], dim=1),
+            torch.stack([width, height], dim=1),
+            torch.stack([zeros, height], dim=1),
+        ],
+        dim=1,
+    )
+    H = perspective_transforms(rect, quads)
+
+    # 縦長の画像は反時計回りに90度回転する
+    rotate = height > thresh_aspect * width
+    rotated_w = torch.where(rotate, height, width)
+    rotated_h = torch.where(rotate, width, height)
+
+    # 目標サイズを超える場合のみ縮小する
+    scale = torch.minimum(
+        (target_w / rotated_w).clamp(max=1), (target_h / rotated_h).clamp(max=1)
+    )
+    resized_w = (rotated_w * scale).floor().clamp(min=1)
+    resized_h = (rotated_h * scale).floor().clamp(min=1)
+
+    # 出力画素の中心を回転後の画像の座標に戻す縮小の逆変換と、回転の逆変換
+    ax = rotated_w / resized_w
+    ay = rotated_h / resized_h
+    bx = 0.5 * ax - 0.5
+    by = 0.5 * ay - 0.5
+    ones = torch.ones_like(ax)
+    A = torch.stack(
+        [
+            torch.where(rotate, zeros, ax),
+            torch.where(rotate, -ay, zeros),
+            torch.where(rotate, width - 1 - by, bx),
+            torch.where(rotate, ax, zeros),
+            torch.where(rotate, zeros, ay),
+            torch.where(rotate, bx, by),
+            zeros,
+            zeros,
+            ones,
+        ],
+        dim=1,
+    ).view(n, 3, 3)
+
+    # grid_sampleの正規化座標への変換
+    N = torch.tensor(
+        [
+            [2 / max(page_w - 1, 1), 0, -1],
+            [0, 2 / max(page_h - 1, 1), -1],
+            [0, 0, 1],
+        ],
+        dtype=H.dtype,
+    )
+    M = (N @ H @ A).float().to(device)
+
+    # パディングのみとなる列と行はサンプリングしない
+    grid_w = int(resized_w.max().item())
+    grid_h = int(resized_h.max().item())
+
+    ys, xs = torch.meshgrid(
+        torch.arange(grid_h, dtype=torch.float32, device=device),
+        torch.arange(grid_w, dtype=torch.float32, device=device),
+        indexing="ij",
+    )
+    points = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(-1, 3)
+    mapped = torch.matmul(points, M.transpose(1, 2))
+    grid = mapped[..., :2] / mapped[..., 2:]
+
+    # パディング領域では射影変換が発散しうるため、範囲外の座標に置き換える
+    grid = torch.nan_to_num(grid, nan=-2.0, posinf=-2.0, neginf=-2.0)
+
+    # ページを複製しないよう、全単語のグリッドを縦に連結して一度にサンプリングする
+    rois = torch.nn.functional.grid_sample(
+        page,
+        grid.to(page.dtype).view(1, n * grid_h, grid_w, 2),
+        mode="bilinear",
+        padding_mode="zeros",
+        align_corners=True,
+    )
+    rois = rois.view(channels, n, grid_h, grid_w).transpose(0, 1)
+
+    valid = (xs[None] < resized_w.float().to(device)[:, None, None]) & (
+        ys[None] < resized_h.float().to(device)[:, None, None]
+    )
+
+    # パディング領域を0とした上で、[-1, 1]に正規化する
+    outputs = torch.full(
+        (n, channels, target_h, target_w), -1.0, dtype=rois.dtype, device=device
+    )
+    outputs[:, :, :grid_h, :grid_w] += rois * (valid[:, None] / 127.5)
+    return outputs
@@ -0,0 +1,202 @@
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# 全スレッドで保持するバッファの合計の上限(バイト)。上限を超える分は呼び出しごとに確保する
+MAX_BUFFER_BYTES = 512 * 1024 * 1024
+
+_local = threading.local()
+_lock = threading.Lock()
+_buffer_bytes = 0
+
+
+class _ThreadBuffers:
+    """
+    Buffers of a thread. They are released when the thread exits, and their size
+    is counted in MAX_BUFFER_BYTES together with the buffers of the other threads.
+    """
+
+    def __init__(self):
+        self.tensors = {}
+
+    def nbytes(self):
+        return sum(
+            tensor.numel() * tensor.element_size() for tensor in self.tensors.values()
+        )
+
+    def replace(self, name, numel):
+        global _buffer_bytes
+
+        old = self.tensors.get(name)
+        old_bytes = 0 if old is None else old.numel() * old.element_size()
+        new_bytes = numel * 4
+        with _lock:
+            if _buffer_bytes - old_bytes + new_bytes > MAX_BUFFER_BYTES:
+                return None
+            _buffer_bytes += new_bytes - old_bytes
+
+        tensor = torch.empty(numel, dtype=torch.float32)
+        self.tensors[name] = tensor
+        return tensor
+
+    def clear(self):
+        global _buffer_bytes
+
+        with _lock:
+            _buffer_bytes -= self.nbytes()
+        self.tensors = {}
+
+    def __del__(self):
+        self.clear()
+
+
+def get_buffer(name: str, shape: tuple[int, ...]) -> torch.Tensor:
+    """
+    Get a float32 buffer of `shape` preallocated for the current thread.
+    The buffer of each name is allocated once and grown only when a larger shape is requested,
+    so the returned tensor is overwritten by the next call with the same name in the same thread.
+    If growing the buffer would exceed MAX_BUFFER_BYTES in total over all threads,
+    a new tensor is allocated for the call instead.
+
+    Args:
+        name (str): name of the buffer
+        shape (tuple[int, ...]): shape of the buffer
+
+    Returns:
+        torch.Tensor: buffer of `shape` (the contents are undefined)
+    """
+
+    buffers = getattr(_local, "buffers", None)
+    if buffers is None:
+        buffers = _local.buffers = _ThreadBuffers()
+
+    numel = int(np.prod(shape))
+    buffer = buffers.tensors.get(name)
+    if buffer is None or buffer.numel() < numel:
+        buffer = buffers.replace(name, numel)
+        if buffer is None:
+            return torch.empty(shape, dtype=torch.float32)
+
+    return buffer[:numel].view(shape)
+
+
+def release_buffers():
+    """
+    Release the buffers preallocated for the current thread.
+    """
+
+    buffers = getattr(_local, "buffers", None)
+    if buffers is not None:
+        buffers.clear()
+
+
+def resize_image(img: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """
+    Resize the uint8 image to `size` before any conversion to float.
+
+    Args:
+        img (np.ndarray): target image(uint8)
+        size (tuple[int, int]): (height, width) after resizing
+
+    Returns:
+        np.ndarray: resized image(uint8). The input is returned as it is if the size is unchanged.
+    """
+
+    h, w = img.shape[:2]
+    new_h, new_w = size
+    if (h, w) == (new_h, new_w):
+        return img
+
+    # 縮小時はエイリアシングを抑えるため面積平均で補間する
+    if new_h < h or new_w < w:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+
+    return cv2.resize(img, (new_w, new_h), interpolation=interpolation)
+
+
+def normalize_image(
+    img: np.ndarray,
+    out: torch.Tensor,
+    mean=IMAGENET_MEAN,
+    std=IMAGENET_STD,
+    to_rgb=True,
+) -> torch.Tensor:
+    """
+    Write the normalized image into `out` in one float32 pass per channel.
+    The channel order, the scaling to [0, 1] and the normalization are fused into
+    a multiply-add, so no intermediate image is allocated.
+
+    Args:
+        img (np.ndarray): target image(BGR, uint8)
+        out (torch.Tensor): (3, H, W) float32 CPU tensor to write the image into
+        mean (tuple, optional): mean of each output channel. Defaults to the ImageNet mean.
+        std (tuple, optional): standard deviation of each output channel. Defaults to the ImageNet std.
+        to_rgb (bool, optional): if True, the channels are written in RGB order, otherwise in BGR order. Defaults to True.
+
+    Returns:
+        torch.Tensor: `out`
+    """
+
+    dst = out.numpy()
+    for c in range(3):
+        src = 2 - c if to_rgb else c
+        scale = 1.0 / (255.0 * std[c])
+        offset = -mean[c] / std[c]
+        np.multiply(img[:, :, src], np.float32(scale), out=dst[c], dtype=np.float32)
+        if offset != 0:
+            dst[c] += np.float32(offset)
+
+    return out
+
+
+def images_to_batch(
+    imgs: list[np.ndarray],
+    shape: tuple[int, int],
+    name: str,
+    mean=IMAGENET_MEAN,
+    std=IMAGENET_STD,
+    to_rgb=True,
+    background=255,
+) -> torch.Tensor:
+    """
+    Build a (N, C, H, W) batch from uint8 images in the buffer preallocated for the current thread.
+    Images smaller than `shape` are placed at the top-left and the rest is padded with the
+    normalized `background` pixel value, so that the padding looks like the page margin.
+    The batch is valid until the next call with the same name in the same thread.
+
+    Args:
+        imgs (list[np.ndarray]): target images(BGR, uint8) not larger than `shape`
+        shape (tuple[int, int]): (height, width) of the batch
+        name (str): name of the buffer
+        mean (tuple, optional): mean of each output channel. Defaults to the ImageNet mean.
+        std (tuple, optional): standard deviation of each output channel. Defaults to the ImageNet std.
+        to_rgb (bool, optional): if True, the channels are written in RGB order, otherwise in BGR order. Defaults to True.
+        background (int, optional): pixel value of the padding before normalization. Defaults to 255 (white).
+
+    Returns:
+        torch.Tensor: (N, C, H, W) batch
+    """
+
+    height, width = shape
+    batch = get_buffer(name, (len(imgs), 3, height, width))
+
+    # 正規化後の0は平均色となるため、パディングは背景の画素値を正規化した値で埋める
+    padding = torch.tensor(
+        [(background / 255.0 - mean[c]) / std[c] for c in range(3)],
+        dtype=torch.float32,
+    ).view(3, 1, 1)
+
+    for k, img in enumerate(imgs):
+        h, w = img.shape[:2]
+        if (h, w) != (height, width):
+            batch[k].copy_(padding.expand(3, height, width))
+        normalize_image(img, batch[k, :, :h, :w], mean, std, to_rgb)
+
+    return batch
@@ -1,12 +1,15 @@
 import asyncio
+import itertools
 from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 
 from pydantic import conlist
 
 from .base import BaseSchema
+from .cache import ResultCache
+from .data.functions import iter_pdf
 from .export import export_csv, export_html, export_markdown
-from .layout_analyzer import LayoutAnalyzer
+from .layout_analyzer import LayoutAnalyzer, LayoutAnalyzerSchema
 from .ocr import OCR, WordPrediction
 from .table_structure_recognizer import TableStructureRecognizerSchema
 from .utils.misc import is_contained, quad_to_xyxy
@@ -148,8 +151,49 @@ def recursive_update(original, new_data):
     return original
 
 
+_END_OF_PIPELINE = object()
+
+
+async def _pipeline_source(func, dst):
+    try:
+        while True:
+            item = await func()
+            if item is None:
+                break
+            await dst.put(item)
+        await dst.put(_END_OF_PIPELINE)
+    except Exception as e:
+        await dst.put(e)
+
+
+async def _pipeline_stage(func, src, dst):
+    while True:
+        item = await src.get()
+        if item is _END_OF_PIPELINE or isinstance(item, Exception):
+            await dst.put(item)
+            return
+
+        try:
+            item = await func(item)
+        except Exception as e:
+            await dst.put(e)
+            return
+
+        await dst.put(item)
+
+
 class DocumentAnalyzer:
-    def __init__(self, configs=None, device="cuda", visualize=False):
+    def __init__(
+        self,
+        configs=None,
+        device="cuda",
+        visualize=False,
+        max_workers=2,
+        cache=None,
+        lazy=False,
+        enable_layout=True,
+        enable_table=True,
+    ):
         default_configs = {
             "ocr": {
                 "text_detector": {
@@ -180,11 +224,77 @@ class DocumentAnalyzer:
                 "configs must be a dict. See the https://kotaro-kinoshita.github.io/yomitoku-dev/usage/"
             )
 
-        self.ocr = OCR(configs=default_configs["ocr"])
-        self.layout = LayoutAnalyzer(configs=default_configs["layout_analyzer"])
+        self.ocr = OCR(configs=default_configs["ocr"], lazy=lazy)
+
+        # レイアウト解析を行わない場合は、OCRの結果のみから段落を構成する
+        self.layout = None
+        if enable_layout:
+            self.layout = LayoutAnalyzer(
+                configs=default_configs["layout_analyzer"],
+                lazy=lazy,
+                enable_table=enable_table,
+            )
+
         self.visualize = visualize
 
-    def aggregate(self, ocr_res, layout_res):
+        # 可視化画像はキャッシュできないため、可視化が有効な場合はキャッシュを使用しない
+        self.cache = cache
+        self.use_cache = cache is not None and not visualize
+
+        # 設定は解析中に変わらないため、キャッシュのキーに用いるダイジェストは一度だけ求める
+        configs = self.ocr.cache_configs()
+        self.cache_namespace = "document_analyzer:layout=False"
+        if self.layout is not None:
+            configs += self.layout.cache_configs()
+            self.cache_namespace = f"document_analyzer:table={self.layout.enable_table}"
+        self.config_digest = ResultCache.digest_configs(configs)
+
+        # OCRとレイアウト解析を並列に実行するためのスレッドプール
+        # 複数ページの同時解析でも使い回せるように、インスタンスと同じ期間保持する
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.ocr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def cache_key(self, img):
+        return ResultCache.make_key(img, self.cache_namespace, [self.config_digest])
+
+    def analyze_layout(self, img):
+        if self.layout is None:
+            return self.empty_layout(img)
+        return self.layout(img)
+
+    def analyze_layout_batch(self, imgs):
+        if self.layout is None:
+            return [self.empty_layout(img) for img in imgs]
+        return self.layout.run_batch(imgs)
+
+    def empty_layout(self, img):
+        results = LayoutAnalyzerSchema(paragraphs=[], tables=[], figures=[])
+        vis = img.copy() if self.visualize else None
+        return results, vis
+
+    def lookup_cache(self, imgs):
+        """
+        Returns:
+            tuple[list[str], list[DocumentAnalyzerSchema]]: cache keys and cached results(None if not cached) of each page
+        """
+
+        if not self.use_cache:
+            return [None] * len(imgs), [None] * len(imgs)
+
+        keys = [self.cache_key(img) for img in imgs]
+        cached = [self.cache.get(key, DocumentAnalyzerSchema) for key in keys]
+        return keys, cached
+
+    def aggregate(self, ocr_res, layout_res, img=None):
         paragraphs = []
         check_list = [False] * len(ocr_res.words)
         for table in layout_res.tables:
@@ -261,7 +371,7 @@ class DocumentAnalyzer:
 
         prediction_reading_order(headers, page_direction)
         prediction_reading_order(footers, page_direction)
-        prediction_reading_order(elements, page_direction, self.img)
+        prediction_reading_order(elements, page_direction, img)
 
         for i, element in enumerate(elements):
             element.order += len(headers)
@@ -283,27 +393,168 @@ class DocumentAnalyzer:
         return outputs
 
     async def run(self, img):
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            loop = asyncio.get_running_loop()
-            tasks = [
-                loop.run_in_executor(executor, self.ocr, img),
-                loop.run_in_executor(executor, self.layout, img),
-            ]
+        if self.use_cache:
+            key = self.cache_key(img)
+            results = self.cache.get(key, DocumentAnalyzerSchema)
+            if results is not None:
+                return results, None, None
+
+        loop = asyncio.get_running_loop()
+        tasks = [
+            loop.run_in_executor(self.executor, self.ocr, img),
+            loop.run_in_executor(self.executor, self.analyze_layout, img),
+        ]
 
-            results = await asyncio.gather(*tasks)
+        results = await asyncio.gather(*tasks)
 
-            results_ocr, ocr = results[0]
-            results_layout, layout = results[1]
+        results_ocr, ocr = results[0]
+        results_layout, layout = results[1]
 
-        outputs = self.aggregate(results_ocr, results_layout)
+        outputs = self.aggregate(results_ocr, results_layout, img)
         results = DocumentAnalyzerSchema(**outputs)
+
+        if self.use_cache:
+            self.cache.put(key, results)
+
         return results, ocr, layout
 
     async def __call__(self, img):
-        self.img = img
         results, ocr, layout = await self.run(img)
 
         if self.visualize:
             layout = reading_order_visualizer(layout, results)
 
         return results, ocr, layout
+
+    async def analyze_pages(self, imgs):
+        """
+        Analyze multiple pages with batched inference.
+        Each model processes the pages in batches instead of one page at a time.
+        Pages found in the cache are not passed to the models.
+
+        Args:
+            imgs (list[np.ndarray]): list of page images(BGR)
+
+        Returns:
+            list[tuple[DocumentAnalyzerSchema, np.ndarray, np.ndarray]]: results, ocr visualization and layout visualization of each page
+        """
+
+        keys, cached = self.lookup_cache(imgs)
+        results_ocr, results_layout = await self.infer_pages(imgs, cached)
+        return self.build_page_results(
+            imgs, keys, cached, results_ocr, results_layout
+        )
+
+    async def infer_pages(self, imgs, cached):
+        targets = [img for img, results in zip(imgs, cached) if results is None]
+        if len(targets) == 0:
+            return [], []
+
+        loop = asyncio.get_running_loop()
+        tasks = [
+            loop.run_in_executor(self.executor, self.ocr.run_batch, targets),
+            loop.run_in_executor(self.executor, self.analyze_layout_batch, targets),
+        ]
+
+        results_ocr, results_layout = await asyncio.gather(*tasks)
+        return results_ocr, results_layout
+
+    def build_page_results(self, imgs, keys, cached, results_ocr, results_layout):
+        outputs = []
+        inferred = zip(results_ocr, results_layout)
+        for img, key, results in zip(imgs, keys, cached):
+            if results is not None:
+                outputs.append((results, None, None))
+                continue
+
+            (ocr_res, ocr), (layout_res, layout) = next(inferred)
+            results = DocumentAnalyzerSchema(
+                **self.aggregate(ocr_res, layout_res, img)
+            )
+
+            if self.use_cache:
+                self.cache.put(key, results)
+
+            if self.visualize:
+                layout = reading_order_visualizer(layout, results)
+
+            outputs.append((results, ocr, layout))
+
+        return outputs
+
+    async def stream(self, pdf_path, dpi=200, batch_size=1, prefetch=2):
+        """
+        Analyze a PDF file as a pipeline and yield the results page by page in order.
+        Rendering, model inference and aggregation run concurrently on different pages,
+        and the pipeline keeps running while the caller processes (e.g. exports) a yielded page.
+
+        Args:
+            pdf_path (str): path to the PDF file
+            dpi (int, optional): resolution to render the pages. Defaults to 200.
+            batch_size (int, optional): number of pages passed to the models at once. Defaults to 1.
+            prefetch (int, optional): number of batches buffered between stages. Defaults to 2.
+
+        Yields:
+            tuple[np.ndarray, DocumentAnalyzerSchema, np.ndarray, np.ndarray]: page image, results, ocr visualization and layout visualization
+        """
+
+        loop = asyncio.get_running_loop()
+        pages = iter_pdf(pdf_path, dpi=dpi)
+
+        # pdfiumはスレッドセーフではないため、描画は専用のスレッドで順番に実行する
+        render_executor = ThreadPoolExecutor(max_workers=1)
+        # キャッシュの参照はファイルの読み込みを伴うため、集約の完了を待たないよう別のスレッドで実行する
+        lookup_executor = ThreadPoolExecutor(max_workers=1)
+        aggregate_executor = ThreadPoolExecutor(max_workers=1)
+
+        rendered = asyncio.Queue(maxsize=prefetch)
+        inferred = asyncio.Queue(maxsize=prefetch)
+        aggregated = asyncio.Queue(maxsize=prefetch)
+
+        async def render():
+            imgs = await loop.run_in_executor(
+                render_executor, lambda: list(itertools.islice(pages, batch_size))
+            )
+            return imgs if len(imgs) > 0 else None
+
+        async def infer(imgs):
+            keys, cached = await loop.run_in_executor(
+                lookup_executor, self.lookup_cache, imgs
+            )
+            results_ocr, results_layout = await self.infer_pages(imgs, cached)
+            return imgs, keys, cached, results_ocr, results_layout
+
+        async def aggregate(item):
+            imgs = item[0]
+            outputs = await loop.run_in_executor(
+                aggregate_executor, self.build_page_results, *item
+            )
+            return imgs, outputs
+
+        tasks = [
+            asyncio.create_task(_pipeline_source(render, rendered)),
+            asyncio.create_task(_pipeline_stage(infer, rendered, inferred)),
+            asyncio.create_task(_pipeline_stage(aggregate, inferred, aggregated)),
+        ]
+
+        try:
+            while True:
+                item = await aggregated.get()
+                if item is _END_OF_PIPELINE:
+                    break
+
+                if isinstance(item, Exception):
+                    raise item
+
+                imgs, outputs = item
+                for img, (results, ocr, layout) in zip(imgs, outputs):
+                    yield img, results, ocr, layout
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            render_executor.submit(pages.close)
+            render_executor.shutdown(wait=False)
+            lookup_executor.shutdown(wait=False)
+            aggregate_executor.shutdown(wait=False)
@@ -1,6 +1,7 @@
 from typing import List
 
-from .base import BaseSchema
+from .base import BaseSchema, LazyModule
+from .cache import ResultCache
 from .layout_parser import Element, LayoutParser
 from .table_structure_recognizer import (
     TableStructureRecognizer,
@@ -15,7 +16,15 @@ class LayoutAnalyzerSchema(BaseSchema):
 
 
 class LayoutAnalyzer:
-    def __init__(self, configs=None, device="cuda", visualize=False):
+    def __init__(
+        self,
+        configs=None,
+        device="cuda",
+        visualize=False,
+        cache=None,
+        lazy=False,
+        enable_table=True,
+    ):
         layout_parser_kwargs = {
             "device": device,
             "visualize": visualize,
@@ -42,17 +51,69 @@ class LayoutAnalyzer:
                 "configs must be a dict. See the https://kotaro-kinoshita.github.io/yomitoku-dev/usage/"
             )
 
-        self.layout_parser = LayoutParser(
+        # lazy=Trueの場合、各モデルは初めて使用される時に読み込まれる
+        self._layout_parser = LazyModule(
+            LayoutParser,
+            lazy=lazy,
             **layout_parser_kwargs,
         )
-        self.table_structure_recognizer = TableStructureRecognizer(
-            **table_structure_recognizer_kwargs,
+
+        # 表の構造解析を行わない場合は、モデルを読み込まない
+        self._table_structure_recognizer = None
+        if enable_table:
+            self._table_structure_recognizer = LazyModule(
+                TableStructureRecognizer,
+                lazy=lazy,
+                **table_structure_recognizer_kwargs,
+            )
+
+        self.enable_table = enable_table
+
+        # 可視化画像はキャッシュできないため、可視化が有効な場合はキャッシュを使用しない
+        self.cache = cache
+        self.use_cache = cache is not None and not (
+            layout_parser_kwargs["visualize"]
+            or (enable_table and table_structure_recognizer_kwargs["visualize"])
+        )
+
+        # 設定は解析中に変わらないため、キャッシュのキーに用いるダイジェストは一度だけ求める
+        self.config_digest = ResultCache.digest_configs(self.cache_configs())
+
+    @property
+    def layout_parser(self):
+        return self._layout_parser.get()
+
+    @property
+    def table_structure_recognizer(self):
+        if self._table_structure_recognizer is None:
+            return None
+        return self._table_structure_recognizer.get()
+
+    def cache_configs(self):
+        configs = [self._layout_parser.cache_config()]
+        if self.enable_table:
+            configs.append(self._table_structure_recognizer.cache_config())
+        return configs
+
+    def cache_key(self, img):
+        return ResultCache.make_key(
+            img, f"layout_analyzer:table={self.enable_table}", [self.config_digest]
         )
 
     def __call__(self, img):
+        if self.use_cache:
+            key = self.cache_key(img)
+            results = self.cache.get(key, LayoutAnalyzerSchema)
+            if results is not None:
+                return results, None
+
         layout_results, vis = self.layout_parser(img)
-        table_boxes = [table.box for table in layout_results.tables]
-        table_results, vis = self.table_structure_recognizer(img, table_boxes, vis=vis)
+        table_results = []
+        if self.enable_table:
+            table_boxes = [table.box for table in layout_results.tables]
+            table_results, vis = self.table_structure_recognizer(
+                img, table_boxes, vis=vis
+            )
 
         results = LayoutAnalyzerSchema(
             paragraphs=layout_results.paragraphs,
@@ -60,4 +121,33 @@ class LayoutAnalyzer:
             figures=layout_results.figures,
         )
 
+        if self.use_cache:
+            self.cache.put(key, results)
+
         return results, vis
+
+    def run_batch(self, imgs):
+        layout_outputs = self.layout_parser.run_batch(imgs)
+        if self.enable_table:
+            table_boxes = [
+                [table.box for table in layout_results.tables]
+                for layout_results, _ in layout_outputs
+            ]
+            table_outputs = self.table_structure_recognizer.run_batch(
+                imgs, table_boxes, vis=[vis for _, vis in layout_outputs]
+            )
+        else:
+            table_outputs = [([], vis) for _, vis in layout_outputs]
+
+        outputs = []
+        for (layout_results, _), (table_results, vis) in zip(
+            layout_outputs, table_outputs
+        ):
+            results = LayoutAnalyzerSchema(
+                paragraphs=layout_results.paragraphs,
+                tables=table_results,
+                figures=layout_results.figures,
+            )
+            outputs.append((results, vis))
+
+        return outputs
@@ -1,18 +1,16 @@
 from typing import List, Union
 
-import cv2
 import os
 import onnx
 import onnxruntime
 import torch
-import torchvision.transforms as T
-from PIL import Image
 from pydantic import conlist
 
 from .constants import ROOT_DIR
 
 from .base import BaseModelCatalog, BaseModule, BaseSchema
 from .configs import LayoutParserRTDETRv2Config
+from .data.preprocess import images_to_batch, resize_image
 from .models import RTDETRv2
 from .postprocessor import RTDETRPostProcessor
 from .utils.misc import filter_by_flag, is_contained
@@ -111,13 +109,6 @@ class LayoutParser(BaseModule):
             num_top_queries=self._cfg.RTDETRTransformerv2.num_queries,
         )
 
-        self.transforms = T.Compose(
-            [
-                T.Resize(self._cfg.data.img_size),
-                T.ToTensor(),
-            ]
-        )
-
         self.thresh_score = self._cfg.thresh_score
 
         self.label_mapper = {
@@ -159,11 +150,12 @@ class LayoutParser(BaseModule):
             dynamic_axes=dynamic_axes,
         )
 
-    def preprocess(self, img):
-        cv_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(cv_img)
-        img_tensor = self.transforms(img)[None]
-        return img_tensor
+    def preprocess(self, imgs):
+        img_size = tuple(self._cfg.data.img_size)
+        resized = [resize_image(img, img_size) for img in imgs]
+        return images_to_batch(
+            resized, img_size, "layout_parser", mean=(0, 0, 0), std=(1, 1, 1)
+        )
 
     def postprocess(self, preds, image_size):
         h, w = image_size
@@ -210,10 +202,7 @@ class LayoutParser(BaseModule):
 
         return category_elements
 
-    def __call__(self, img):
-        ori_h, ori_w = img.shape[:2]
-        img_tensor = self.preprocess(img)
-
+    def infer(self, img_tensor):
         if self.infer_onnx:
             input = img_tensor.numpy()
             results = self.sess.run(None, {"input": input})
@@ -227,6 +216,12 @@ class LayoutParser(BaseModule):
                 img_tensor = img_tensor.to(self.device)
                 preds = self.model(img_tensor)
 
+        return preds
+
+    def __call__(self, img):
+        ori_h, ori_w = img.shape[:2]
+        img_tensor = self.preprocess([img])
+        preds = self.infer(img_tensor)
         results = self.postprocess(preds, (ori_h, ori_w))
 
         vis = None
@@ -237,3 +232,39 @@ class LayoutParser(BaseModule):
             )
 
         return results, vis
+
+    def run_batch(self, imgs):
+        """apply the layout model to multiple images with batched inference.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+
+        Returns:
+            list[tuple[LayoutParserSchema, np.ndarray]]: results and visualization of each image
+        """
+
+        outputs = []
+        batch_size = self._cfg.data.batch_size
+        for start in range(0, len(imgs), batch_size):
+            batch_imgs = imgs[start : start + batch_size]
+            img_tensor = self.preprocess(batch_imgs)
+            preds = self.infer(img_tensor)
+
+            orig_size = torch.tensor(
+                [[img.shape[1], img.shape[0]] for img in batch_imgs]
+            ).to(self.device)
+            batch_outputs = self.postprocessor(preds, orig_size, self.thresh_score)
+
+            for img, output in zip(batch_imgs, batch_outputs):
+                results = LayoutParserSchema(**self.filtering_elements(output))
+
+                vis = None
+                if self.visualize:
+                    vis = layout_visualizer(
+                        results,
+                        img,
+                    )
+
+                outputs.append((results, vis))
+
+        return outputs
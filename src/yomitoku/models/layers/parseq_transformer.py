@@ -98,6 +98,43 @@ class DecoderLayer(nn.Module):
         tgt = tgt + self.dropout3(tgt2)
         return tgt, sa_weights, ca_weights
 
+    def project_kv(self, attn: nn.MultiheadAttention, x: Tensor):
+        """Project x to the keys and values of attn, split into heads: (N, num_heads, L, head_dim)"""
+        E = attn.embed_dim
+        N, L, _ = x.shape
+        w, b = attn.in_proj_weight, attn.in_proj_bias
+        k = F.linear(x, w[E : 2 * E], b[E : 2 * E])
+        v = F.linear(x, w[2 * E :], b[2 * E :])
+        shape = (N, L, attn.num_heads, E // attn.num_heads)
+        return k.view(shape).transpose(1, 2), v.view(shape).transpose(1, 2)
+
+    def attend(self, attn: nn.MultiheadAttention, x: Tensor, k: Tensor, v: Tensor):
+        """Attention of x to the projected keys and values without masks (inference only)"""
+        E = attn.embed_dim
+        N, L, _ = x.shape
+        q = F.linear(x, attn.in_proj_weight[:E], attn.in_proj_bias[:E])
+        q = q.view(N, L, attn.num_heads, E // attn.num_heads).transpose(1, 2)
+        out = F.scaled_dot_product_attention(q, k, v)
+        out = out.transpose(1, 2).reshape(N, L, E)
+        return attn.out_proj(out)
+
+    def forward_stream_cached(
+        self,
+        tgt: Tensor,
+        tgt_norm: Tensor,
+        tgt_k: Tensor,
+        tgt_v: Tensor,
+        memory_kv,
+    ):
+        """Incremental version of forward_stream for inference.
+        tgt attends to all the cached keys/values tgt_k, tgt_v of the content,
+        and memory_kv holds the keys/values of the memory projected once per batch.
+        """
+        tgt = tgt + self.attend(self.self_attn, tgt_norm, tgt_k, tgt_v)
+        tgt = tgt + self.attend(self.cross_attn, self.norm1(tgt), *memory_kv)
+        tgt = tgt + self.linear2(self.activation(self.linear1(self.norm2(tgt))))
+        return tgt
+
     def forward(
         self,
         query,
@@ -168,6 +205,59 @@ class Decoder(nn.Module):
         query = self.norm(query)
         return query
 
+    def init_cache(self, memory: Tensor, num_steps: int):
+        """Allocate the key/value cache for incremental decoding of up to num_steps tokens.
+        The keys/values of the memory are projected here once for all steps.
+        """
+        N = memory.shape[0]
+        cache = {"length": 0, "memory": [], "self": []}
+        for mod in self.layers:
+            attn = mod.self_attn
+            shape = (N, attn.num_heads, num_steps, attn.embed_dim // attn.num_heads)
+            cache["memory"].append(mod.project_kv(mod.cross_attn, memory))
+            cache["self"].append(
+                (
+                    memory.new_empty(shape),
+                    memory.new_empty(shape),
+                )
+            )
+        return cache
+
+    def compact_cache(self, cache, keep: Tensor):
+        """Drop the rows of the batch from the key/value cache where keep is False."""
+        cache["memory"] = [(k[keep], v[keep]) for k, v in cache["memory"]]
+        cache["self"] = [(k[keep], v[keep]) for k, v in cache["self"]]
+
+    def forward_step(self, query: Tensor, content: Tensor, cache):
+        """Decode one position with the key/value cache.
+
+        Args:
+            query: (N, 1, E) position query of the current step
+            content: (N, 1, E) content embedding of the latest token
+            cache: key/value cache created by init_cache, updated in place
+        """
+        i = cache["length"]
+        for n, mod in enumerate(self.layers):
+            last = n == len(self.layers) - 1
+            content_norm = mod.norm_c(content)
+
+            # 新しいトークンのキーとバリューのみを計算してキャッシュに追加する
+            k_cache, v_cache = cache["self"][n]
+            k, v = mod.project_kv(mod.self_attn, content_norm)
+            k_cache[:, :, i : i + 1] = k
+            v_cache[:, :, i : i + 1] = v
+            k, v = k_cache[:, :, : i + 1], v_cache[:, :, : i + 1]
+
+            memory_kv = cache["memory"][n]
+            query = mod.forward_stream_cached(query, mod.norm_q(query), k, v, memory_kv)
+            if not last:
+                content = mod.forward_stream_cached(
+                    content, content_norm, k, v, memory_kv
+                )
+
+        cache["length"] = i + 1
+        return self.norm(query)
+
 
 class Encoder(VisionTransformer):
     def __init__(
@@ -205,8 +295,33 @@ class Encoder(VisionTransformer):
 
     def forward(self, x):
         # Return all tokens
+        if x.shape[-1] < self.patch_embed.img_size[1]:
+            return self.forward_features_narrow(x)
         return self.forward_features(x)
 
+    def forward_features_narrow(self, x):
+        """Forward pass for an input narrower than img_size (e.g. a batch of short words).
+        The input is regarded as the left part of a full-width image, so the position
+        embeddings of the leftmost patch columns are used.
+        """
+        grid_h, grid_w = self.patch_embed.grid_size
+        patch_w = self.patch_embed.patch_size[1]
+        if x.shape[-1] % patch_w != 0:
+            raise ValueError(
+                f"Input width {x.shape[-1]} is not a multiple of the patch width {patch_w}."
+            )
+
+        x = self.patch_embed.proj(x)
+        width = x.shape[-1]
+        x = self.patch_embed.norm(x.flatten(2).transpose(1, 2))
+
+        pos_embed = self.pos_embed.view(1, grid_h, grid_w, -1)[:, :, :width]
+        x = self.pos_drop(x + pos_embed.reshape(1, grid_h * width, -1))
+        x = self.patch_drop(x)
+        x = self.norm_pre(x)
+        x = self.blocks(x)
+        return self.norm(x)
+
 
 class TokenEmbedding(nn.Module):
     def __init__(self, charset_size: int, embed_dim: int):
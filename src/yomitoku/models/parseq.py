@@ -18,6 +18,7 @@ from typing import Optional, Sequence
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from huggingface_hub import PyTorchModelHubMixin
 from timm.models.helpers import named_apply
 from torch import Tensor
@@ -120,11 +121,284 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
             tgt_padding_mask,
         )
 
+    def use_cached_decoding(self) -> bool:
+        # 学習時とONNXへの変換時は、全系列を再計算する元の実装を使用する
+        return not (
+            self.training
+            or torch.jit.is_tracing()
+            or torch.jit.is_scripting()
+            or torch.onnx.is_in_onnx_export()
+        )
+
+    def vocab_head(self, vocab: Optional[Tensor] = None):
+        """Output projection restricted to the token ids in vocab.
+        The logits of the restricted head are indexed by the position in vocab, so vocab must
+        start with <eos> to keep its index. The projection is sliced from the head weights,
+        so the cost of each step shrinks with the size of vocab.
+        """
+        if vocab is None:
+            return self.head
+        return partial(
+            F.linear, weight=self.head.weight[vocab], bias=self.head.bias[vocab]
+        )
+
+    @staticmethod
+    def to_token_ids(ids: Tensor, vocab: Optional[Tensor] = None) -> Tensor:
+        # 制限された語彙での番号を元のトークンIDに戻す
+        return ids if vocab is None else vocab[ids]
+
+    def decode_ar_cached(
+        self,
+        memory: Tensor,
+        pos_queries: Tensor,
+        testing: bool,
+        vocab: Optional[Tensor] = None,
+    ):
+        """Greedy autoregressive decoding with a key/value cache.
+        Each step embeds only the latest token and attends to the cached keys/values of the
+        previous tokens, and the memory is projected once per batch, so the cost of a step
+        does not grow with the length of the prefix.
+
+        When testing, the rows that have produced <eos> are dropped from the working batch
+        (together with their cache) once they make up a quarter of it, so the computation
+        follows the unfinished rows. The logits of the dropped rows after <eos> are left at zero,
+        which is never read since the labels are truncated at the first <eos>.
+        """
+        bs, num_steps = pos_queries.shape[:2]
+        eos_id = self.tokenizer.eos_id
+        tgt_in = torch.full(
+            (bs, num_steps),
+            self.tokenizer.pad_id,
+            dtype=torch.long,
+            device=self._device,
+        )
+        tgt_in[:, 0] = self.tokenizer.bos_id
+
+        head = self.vocab_head(vocab)
+        num_classes = self.head.out_features if vocab is None else len(vocab)
+        logits = memory.new_zeros(bs, num_steps, num_classes)
+        cache = self.decoder.init_cache(memory, num_steps)
+        content = self.text_embed(tgt_in[:, :1])
+
+        # 作業バッチの各行に対応する元のバッチの行番号
+        rows = torch.arange(bs, device=self._device)
+        finished = torch.zeros(bs, dtype=torch.bool, device=self._device)
+
+        steps = num_steps
+        for i in range(num_steps):
+            j = i + 1
+            query = self.pos_queries[:, i:j].expand(len(rows), -1, -1)
+            tgt_out = self.decoder.forward_step(query, content, cache)
+            p_i = head(tgt_out)
+            logits[rows, i] = p_i[:, 0]
+            if j == num_steps:
+                break
+
+            next_tokens = self.to_token_ids(p_i[:, 0].argmax(-1), vocab)
+            tgt_in[rows, j] = next_tokens
+
+            if testing:
+                finished |= next_tokens == eos_id
+                if finished.all():
+                    steps = j
+                    break
+
+                # 終了した行が作業バッチの1/4に達したら、キャッシュごと取り除く
+                if finished.sum() * 4 >= len(rows):
+                    keep = ~finished
+                    rows = rows[keep]
+                    next_tokens = next_tokens[keep]
+                    finished = finished[keep]
+                    self.decoder.compact_cache(cache, keep)
+
+            # 次のステップでは、直前に予測したトークンのみを埋め込む
+            content = self.pos_queries[:, i:j] + self.text_embed(next_tokens[:, None])
+
+        return tgt_in, logits[:, :steps]
+
+    def refine_rows(
+        self,
+        memory: Tensor,
+        tgt_in: Tensor,
+        num_queries: int,
+        tgt_mask: Tensor,
+        query_mask: Tensor,
+        vocab: Optional[Tensor] = None,
+    ):
+        # <eos>以降のトークンはマスクする
+        tgt_padding_mask = (tgt_in == self.tokenizer.eos_id).int().cumsum(-1) > 0
+        L = tgt_in.shape[1]
+        tgt_out = self.decode(
+            tgt_in,
+            memory,
+            tgt_mask[:L, :L],
+            tgt_padding_mask,
+            self.pos_queries[:, :num_queries].expand(tgt_in.shape[0], -1, -1),
+            query_mask[:num_queries, :L],
+        )
+        return self.vocab_head(vocab)(tgt_out)
+
+    def refine_by_length(
+        self,
+        memory: Tensor,
+        logits: Tensor,
+        num_steps: int,
+        vocab: Optional[Tensor] = None,
+    ):
+        """Iterative refinement with the rows grouped by the length of their labels.
+
+        The sequences of each group are truncated to the longest label in the group
+        (rounded up to a multiple of 8). Tokens after the first <eos> are masked in the
+        refinement, so the truncated positions give the same logits as the full sequence
+        as long as the refined label still ends within the truncated length. The rows
+        whose refined label does not end there are refined again with the full length.
+        """
+        bs = logits.shape[0]
+        eos_id = self.tokenizer.eos_id
+
+        # forward の精緻化と同じマスクを作る(2つのマスクは同じテンソルを共有する)
+        tgt_mask = query_mask = torch.triu(
+            torch.ones((num_steps, num_steps), dtype=torch.bool, device=self._device),
+            1,
+        )
+        query_mask[
+            torch.triu(
+                torch.ones(
+                    num_steps,
+                    num_steps,
+                    dtype=torch.int64,
+                    device=self._device,
+                ),
+                2,
+            )
+        ] = 0
+
+        bos = torch.full(
+            (bs, 1), self.tokenizer.bos_id, dtype=torch.long, device=self._device
+        )
+        for _ in range(self.refine_iters):
+            tgt_in = torch.cat(
+                [bos, self.to_token_ids(logits[:, :-1].argmax(-1), vocab)], dim=1
+            )
+            steps = tgt_in.shape[1]
+
+            is_eos = logits.argmax(-1) == eos_id
+            lengths = torch.where(
+                is_eos.any(-1),
+                is_eos.int().argmax(-1) + 1,
+                torch.full_like(is_eos[:, 0], steps, dtype=torch.long),
+            )
+            buckets = ((lengths + 7) // 8 * 8).clamp(max=steps)
+
+            refined = logits.new_zeros(bs, num_steps, logits.shape[2])
+            retry = []
+            for length in buckets.unique().tolist():
+                rows = (buckets == length).nonzero().flatten()
+                if length == steps:
+                    # 系列全体を使うグループは、元の実装と同じく全ての位置を問い合わせる
+                    retry.append(rows)
+                    continue
+
+                out = self.refine_rows(
+                    memory[rows],
+                    tgt_in[rows, :length],
+                    length,
+                    tgt_mask,
+                    query_mask,
+                    vocab,
+                )
+
+                # 精緻化後のラベルが切り詰めた長さの中で終わらない行は全長でやり直す
+                ok = (out.argmax(-1) == eos_id).any(-1)
+                refined[rows[ok], :length] = out[ok]
+                retry.append(rows[~ok])
+
+            rows = torch.cat(retry)
+            if len(rows) > 0:
+                refined[rows] = self.refine_rows(
+                    memory[rows], tgt_in[rows], num_steps, tgt_mask, query_mask, vocab
+                )
+
+            logits = refined
+
+        return logits
+
+    def label_ids(self, logits: Tensor) -> Tensor:
+        # 最初の<eos>以降のトークンを<eos>で埋めたトークン列
+        ids = logits.argmax(-1)
+        is_eos = (ids == self.tokenizer.eos_id).int()
+        return ids.masked_fill(is_eos.cumsum(-1) - is_eos > 0, self.tokenizer.eos_id)
+
+    def min_token_probs(self, logits: Tensor) -> Tensor:
+        # 最初の<eos>まで(<eos>自身を含む)の各トークンの確率の最小値
+        max_logits, ids = logits.max(-1)
+        probs = (max_logits - logits.logsumexp(-1)).exp()
+        is_eos = (ids == self.tokenizer.eos_id).int()
+        probs = probs.masked_fill(is_eos.cumsum(-1) - is_eos > 0, 1.0)
+        return probs.amin(-1)
+
+    def forward_hybrid(
+        self, images: Tensor, vocab: Optional[Tensor] = None
+    ) -> tuple[Tensor, Tensor]:
+        """Hybrid decoding for inference.
+        The batch is decoded in one non-autoregressive pass followed by the iterative refinement,
+        and only the rows whose token probabilities fall below `cfg.hybrid.thresh`, or whose
+        labels are changed by the refinement, are decoded again autoregressively.
+
+        Args:
+            images: (N, C, H, W) batch of word images
+            vocab: token ids to restrict the output to, starting with <eos>
+
+        Returns:
+            logits of the labels and (N,) mask of the rows decoded autoregressively
+        """
+        bs = images.shape[0]
+        num_steps = self.max_label_length + 1
+        memory = self.encode(images)
+        pos_queries = self.pos_queries[:, :num_steps].expand(bs, -1, -1)
+
+        # <bos>のみを文脈として全ての位置を一度に推論する
+        tgt_in = torch.full(
+            (bs, 1), self.tokenizer.bos_id, dtype=torch.long, device=self._device
+        )
+        head = self.vocab_head(vocab)
+        logits_nar = head(self.decode(tgt_in, memory, tgt_query=pos_queries))
+
+        logits = logits_nar
+        fallback = self.min_token_probs(logits_nar) < self.cfg.hybrid.thresh
+        if self.refine_iters:
+            logits = self.refine_by_length(memory, logits_nar, num_steps, vocab)
+            fallback |= self.min_token_probs(logits) < self.cfg.hybrid.thresh
+            fallback |= (self.label_ids(logits) != self.label_ids(logits_nar)).any(-1)
+
+        rows = fallback.nonzero().flatten()
+        if len(rows) > 0:
+            _, logits_ar = self.decode_ar_cached(
+                memory[rows], pos_queries[rows], testing=True, vocab=vocab
+            )
+            if self.refine_iters:
+                logits_ar = self.refine_by_length(
+                    memory[rows], logits_ar, num_steps, vocab
+                )
+
+            logits[rows] = 0
+            logits[rows, : logits_ar.shape[1]] = logits_ar
+
+        return logits, fallback
+
     def forward(
         self,
         images: Tensor,
         max_length: Optional[int] = None,
+        vocab: Optional[Tensor] = None,
     ) -> Tensor:
+        if (
+            self.cfg.hybrid.enabled
+            and max_length is None
+            and self.use_cached_decoding()
+        ):
+            return self.forward_hybrid(images, vocab)[0]
+
         testing = max_length is None
         max_length = (
             self.max_label_length
@@ -135,6 +409,7 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
         # +1 for <eos> at end of sequence.
         num_steps = max_length + 1
         memory = self.encode(images)
+        head = self.vocab_head(vocab)
 
         # Query positions up to `num_steps`
         pos_queries = self.pos_queries[:, :num_steps].expand(bs, -1, -1)
@@ -145,7 +420,9 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
             1,
         )
 
-        if self.decode_ar:
+        if self.decode_ar and self.use_cached_decoding():
+            tgt_in, logits = self.decode_ar_cached(memory, pos_queries, testing, vocab)
+        elif self.decode_ar:
             tgt_in = torch.full(
                 (bs, num_steps),
                 self.tokenizer.pad_id,
@@ -169,11 +446,11 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
                     tgt_query_mask=query_mask[i:j, :j],
                 )
                 # the next token probability is in the output's ith token position
-                p_i = self.head(tgt_out)
+                p_i = head(tgt_out)
                 logits.append(p_i)
                 if j < num_steps:
                     # greedy decode. add the next token index to the target input
-                    tgt_in[:, j] = p_i.squeeze().argmax(-1)
+                    tgt_in[:, j] = self.to_token_ids(p_i.squeeze().argmax(-1), vocab)
                     # Efficient batch decoding: If all output words have at least one EOS token, end decoding.
                     if testing and (tgt_in == self.tokenizer.eos_id).any(dim=-1).all():
                         break
@@ -188,9 +465,11 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
                 device=self._device,
             )
             tgt_out = self.decode(tgt_in, memory, tgt_query=pos_queries)
-            logits = self.head(tgt_out)
+            logits = head(tgt_out)
 
-        if self.refine_iters:
+        if self.refine_iters and testing and self.use_cached_decoding():
+            logits = self.refine_by_length(memory, logits, num_steps, vocab)
+        elif self.refine_iters:
             # For iterative refinement, we always use a 'cloze' mask.
             # We can derive it from the AR forward mask by unmasking the token context to the right.
             query_mask[
@@ -212,7 +491,9 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
             )
             for i in range(self.refine_iters):
                 # Prior context is the previous output.
-                tgt_in = torch.cat([bos, logits[:, :-1].argmax(-1)], dim=1)
+                tgt_in = torch.cat(
+                    [bos, self.to_token_ids(logits[:, :-1].argmax(-1), vocab)], dim=1
+                )
                 # Mask tokens beyond the first EOS token.
                 tgt_padding_mask = (tgt_in == self.tokenizer.eos_id).int().cumsum(
                     -1
@@ -225,6 +506,6 @@ class PARSeq(nn.Module, PyTorchModelHubMixin):
                     pos_queries,
                     query_mask[:, : tgt_in.shape[1]],
                 )
-                logits = self.head(tgt_out)
+                logits = head(tgt_out)
 
         return logits
@@ -1,11 +1,12 @@
-from typing import List
+from typing import List, Union
 
 from pydantic import conlist
 
 from yomitoku.text_detector import TextDetector
 from yomitoku.text_recognizer import TextRecognizer
 
-from .base import BaseSchema
+from .base import BaseSchema, LazyModule
+from .cache import ResultCache
 
 
 class WordPrediction(BaseSchema):
@@ -18,6 +19,8 @@ class WordPrediction(BaseSchema):
     direction: str
     det_score: float
     rec_score: float
+    # 文字認識の推論方法("ar": 自己回帰、"nar": 非自己回帰と精緻化)
+    decode_path: Union[str, None] = None
 
 
 class OCRSchema(BaseSchema):
@@ -25,7 +28,14 @@ class OCRSchema(BaseSchema):
 
 
 class OCR:
-    def __init__(self, configs=None, device="cuda", visualize=False):
+    def __init__(
+        self,
+        configs=None,
+        device="cuda",
+        visualize=False,
+        cache=None,
+        lazy=False,
+    ):
         text_detector_kwargs = {
             "device": device,
             "visualize": visualize,
@@ -49,17 +59,53 @@ class OCR:
                 "configs must be a dict. See the https://kotaro-kinoshita.github.io/yomitoku-dev/usage/"
             )
 
-        self.detector = TextDetector(**text_detector_kwargs)
-        self.recognizer = TextRecognizer(**text_recognizer_kwargs)
+        # lazy=Trueの場合、各モデルは初めて使用される時に読み込まれる
+        self._detector = LazyModule(TextDetector, lazy=lazy, **text_detector_kwargs)
+        self._recognizer = LazyModule(
+            TextRecognizer, lazy=lazy, **text_recognizer_kwargs
+        )
+
+        # 可視化画像はキャッシュできないため、可視化が有効な場合はキャッシュを使用しない
+        self.cache = cache
+        self.use_cache = cache is not None and not (
+            text_detector_kwargs["visualize"] or text_recognizer_kwargs["visualize"]
+        )
+
+        # 設定は解析中に変わらないため、キャッシュのキーに用いるダイジェストは一度だけ求める
+        self.config_digest = ResultCache.digest_configs(self.cache_configs())
+
+    @property
+    def detector(self):
+        return self._detector.get()
+
+    @property
+    def recognizer(self):
+        return self._recognizer.get()
+
+    def close(self):
+        # 読み込み済みの認識モデルの切り出しスレッドのみ停止する
+        if self._recognizer.loaded:
+            self.recognizer.close()
+
+    def cache_configs(self):
+        return [self._detector.cache_config(), self._recognizer.cache_config()]
+
+    def cache_key(self, img):
+        return ResultCache.make_key(img, "ocr", [self.config_digest])
 
     def aggregate(self, det_outputs, rec_outputs):
+        decode_paths = rec_outputs.decode_paths
+        if len(decode_paths) == 0:
+            decode_paths = [None] * len(rec_outputs.contents)
+
         words = []
-        for points, det_score, pred, rec_score, direction in zip(
+        for points, det_score, pred, rec_score, direction, decode_path in zip(
             det_outputs.points,
             det_outputs.scores,
             rec_outputs.contents,
             rec_outputs.scores,
             rec_outputs.directions,
+            decode_paths,
         ):
             words.append(
                 {
@@ -68,6 +114,7 @@ class OCR:
                     "direction": direction,
                     "det_score": det_score,
                     "rec_score": rec_score,
+                    "decode_path": decode_path,
                 }
             )
         return words
@@ -79,9 +126,39 @@ class OCR:
             img (np.ndarray): cv2 image(BGR)
         """
 
+        if self.use_cache:
+            key = self.cache_key(img)
+            results = self.cache.get(key, OCRSchema)
+            if results is not None:
+                return results, None
+
         det_outputs, vis = self.detector(img)
         rec_outputs, vis = self.recognizer(img, det_outputs.points, vis=vis)
 
         outputs = {"words": self.aggregate(det_outputs, rec_outputs)}
         results = OCRSchema(**outputs)
+
+        if self.use_cache:
+            self.cache.put(key, results)
+
         return results, vis
+
+    def run_batch(self, imgs):
+        """
+        Args:
+            imgs (list[np.ndarray]): cv2 images(BGR)
+        """
+
+        det_outputs = self.detector.run_batch(imgs)
+        rec_outputs = self.recognizer.run_batch(
+            imgs,
+            [det_results.points for det_results, _ in det_outputs],
+            vis=[vis for _, vis in det_outputs],
+        )
+
+        outputs = []
+        for (det_results, _), (rec_results, vis) in zip(det_outputs, rec_outputs):
+            words = self.aggregate(det_results, rec_results)
+            outputs.append((OCRSchema(words=words), vis))
+
+        return outputs
@@ -1,17 +1,25 @@
 import cv2
 import math
 import numpy as np
-import pyclipper
-from shapely.geometry import Polygon
+import torch
 
 
 class DBnetPostProcessor:
-    def __init__(self, min_size, thresh, box_thresh, max_candidates, unclip_ratio):
+    def __init__(
+        self,
+        min_size,
+        thresh,
+        box_thresh,
+        max_candidates,
+        unclip_ratio,
+        vectorized=False,
+    ):
         self.min_size = min_size
         self.thresh = thresh
         self.box_thresh = box_thresh
         self.max_candidates = max_candidates
         self.unclip_ratio = unclip_ratio
+        self.vectorized = vectorized
 
     def __call__(self, preds, image_size):
         """
@@ -20,28 +28,68 @@ class DBnetPostProcessor:
             thresh: [if exists] thresh hold prediction with shape (N, H, W)
             thresh_binary: [if exists] binarized with threshhold, (N, H, W)
         """
-        pred = preds["binary"][0]
-        segmentation = self.binarize(pred)[0]
+        pred = preds["binary"][0][0]
+        bitmap, pred = self.transfer(pred)
         height, width = image_size
-        quads, scores = self.boxes_from_bitmap(pred, segmentation, width, height)
+        if self.vectorized:
+            quads, scores = self.boxes_from_bitmap_vectorized(
+                pred, bitmap, width, height
+            )
+        else:
+            quads, scores = self.boxes_from_bitmap(pred, bitmap, width, height)
         return quads, scores
 
     def binarize(self, pred):
         return pred > self.thresh
 
-    def boxes_from_bitmap(self, pred, _bitmap, dest_width, dest_height):
+    def transfer(self, pred, compact=None):
         """
-        _bitmap: single map with shape (H, W),
-            whose values are binarized as {0, 1}
+        Binarize the probability map on its device and copy it to host.
+        On devices other than CPU, the mask is packed into bits and the scores are copied
+        in half precision, which reduces the transfer to about 2.1 bytes per pixel.
+        The whole score map is copied because the scores of the holes inside a contour
+        are also averaged by box_score_fast.
+
+        pred: probability map with shape (H, W)
+        compact: whether to pack the transfer. Defaults to True on devices other than CPU.
+
+        Returns:
+            bitmap: binarized map with shape (H, W), whose values are {0, 1} (np.uint8)
+            pred: probability map with shape (H, W) (np.float32)
         """
 
-        assert len(_bitmap.shape) == 2
-        bitmap = _bitmap.cpu().numpy()  # The first channel
+        pred = pred.detach()
+        mask = self.binarize(pred)
+        if compact is None:
+            compact = pred.device.type != "cpu"
+
+        if not compact:
+            return mask.cpu().numpy().view(np.uint8), pred.float().cpu().numpy()
+
+        # 1画素1ビットに詰めたマスクと、半精度のスコアを転送する
+        # 輪郭内の穴のスコアも平均に含まれるため、スコアはマップ全体を転送する
+        height, width = mask.shape
+        bits = torch.nn.functional.pad(mask.to(torch.uint8), (0, -width % 8))
+        weights = torch.tensor(
+            [128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=mask.device
+        )
+        packed = (bits.view(height, -1, 8) * weights).sum(dim=-1, dtype=torch.uint8)
+        scores = pred.to(torch.float16).cpu().numpy().astype(np.float32)
+
+        bitmap = np.unpackbits(packed.cpu().numpy(), axis=1)[:, :width]
+        return np.ascontiguousarray(bitmap), scores
+
+    def boxes_from_bitmap(self, pred, bitmap, dest_width, dest_height):
+        """
+        pred: probability map with shape (H, W)
+        bitmap: single map with shape (H, W),
+            whose values are binarized as {0, 1}
+        """
 
-        pred = pred.cpu().detach().numpy()[0]
+        assert len(bitmap.shape) == 2
         height, width = bitmap.shape
         contours, _ = cv2.findContours(
-            (bitmap * 255).astype(np.uint8),
+            bitmap,
             cv2.RETR_LIST,
             cv2.CHAIN_APPROX_SIMPLE,
         )
@@ -52,18 +100,21 @@ class DBnetPostProcessor:
         scores = []
         for index in range(num_contours):
             contour = contours[index].squeeze(1)
-            points, sside = self.get_mini_boxes(contour)
+            bounding_box = cv2.minAreaRect(contour)
+            _, sside = self.rect_to_box(bounding_box)
 
             if sside < self.min_size:
                 continue
-            points = np.array(points)
             score = self.box_score_fast(pred, contour)
 
             if self.box_thresh > score:
                 continue
 
-            box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
+            # 入力は常に矩形のため、多角形の膨張を経由せずに膨張後の矩形を直接求める
+            bounding_box = self.unclip_rect(
+                bounding_box, unclip_ratio=self.unclip_ratio
+            )
+            box, sside = self.rect_to_box(bounding_box)
             if sside < self.min_size + 2:
                 continue
             box = np.array(box)
@@ -81,24 +132,155 @@ class DBnetPostProcessor:
 
         return boxes, scores
 
-    def unclip(self, box, unclip_ratio=7):
+    def boxes_from_bitmap_vectorized(self, pred, bitmap, dest_width, dest_height):
+        """
+        Array version of boxes_from_bitmap, which returns the same boxes and scores.
+        The candidates and their minimum area rectangles are the same as boxes_from_bitmap,
+        and the filtering, unclipping and scaling of the rectangles are computed for all
+        candidates at once. The minimum area rectangles and the scores are still computed
+        per candidate, but the scores only for the candidates larger than min_size.
+
+        The scores are not reduced by connected-component labels: labeling and reducing
+        the whole map costs more than filling the small bounding box of each candidate.
+
+        pred: probability map with shape (H, W)
+        bitmap: single map with shape (H, W),
+            whose values are binarized as {0, 1}
+        """
+
+        assert len(bitmap.shape) == 2
+        height, width = bitmap.shape
+        contours, _ = cv2.findContours(
+            bitmap,
+            cv2.RETR_LIST,
+            cv2.CHAIN_APPROX_SIMPLE,
+        )
+        contours = contours[: self.max_candidates]
+        if len(contours) == 0:
+            return [], []
+
+        # 最小外接矩形は各輪郭の凸包に対する回転キャリパー法(cv2.minAreaRect)で求める
+        rects = [cv2.minAreaRect(contour) for contour in contours]
+        centers = np.array([rect[0] for rect in rects], dtype=np.float32)
+        sizes = np.array([rect[1] for rect in rects], dtype=np.float64)
+        angles = np.array([rect[2] for rect in rects], dtype=np.float32)
+
+        keep = sizes.min(axis=1) >= self.min_size
+
+        # スコアは輪郭で囲まれた領域(穴を含む)の平均で、box_score_fastと同じ値を求める
+        # 連結成分のラベルごとの集計はマップ全体の走査が必要で、候補の外接矩形のみを塗りつぶすより遅い
+        bboxes = [cv2.boundingRect(contour) for contour in contours]
+        scores = np.zeros(len(contours))
+        for i in np.flatnonzero(keep):
+            x, y, w, h = bboxes[i]
+            mask = np.zeros((h, w), dtype=np.uint8)
+            cv2.fillPoly(mask, [contours[i]], 1, offset=(-x, -y))
+            scores[i] = cv2.mean(pred[y : y + h, x : x + w], mask)[0]
+        keep &= scores >= self.box_thresh
+
+        # unclip_rectと同様に、矩形の各辺を同じ距離だけ外側に移動する
+        boxes = self.box_points(centers, sizes, angles)
+        extent = boxes.max(axis=1) - boxes.min(axis=1)
+        box_dist = np.minimum(extent[:, 0], extent[:, 1]).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = self.unclip_ratio / np.sqrt(box_dist)
+            area = sizes[:, 0] * sizes[:, 1]
+            distance = area * ratio / (2 * (sizes[:, 0] + sizes[:, 1]))
+            sizes = sizes + 2 * distance[:, None]
+            keep &= sizes.min(axis=1) >= self.min_size + 2
+
+        if not keep.any():
+            return [], []
+
+        boxes = self.box_points(centers[keep], sizes[keep], angles[keep])
+        boxes = self.order_points(boxes)
+
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+
+        boxes[:, :, 0] = np.clip(
+            np.round(boxes[:, :, 0] / width * dest_width), 0, dest_width
+        )
+        boxes[:, :, 1] = np.clip(
+            np.round(boxes[:, :, 1] / height * dest_height), 0, dest_height
+        )
+
+        return boxes.astype(np.int16).tolist(), scores[keep].tolist()
+
+    @staticmethod
+    def box_points(centers, sizes, angles):
+        """
+        Array version of cv2.boxPoints, which computes the corners in single precision
+        in the same order of operations.
+        centers: (N, 2), sizes: (N, 2), angles: (N,) in degrees -> (N, 4, 2) (np.float32)
+        """
+        centers = centers.astype(np.float32)
+        w, h = sizes.astype(np.float32).T
+        theta = angles.astype(np.float32).astype(np.float64) * np.pi / 180.0
+        b = np.cos(theta).astype(np.float32) * np.float32(0.5)
+        a = np.sin(theta).astype(np.float32) * np.float32(0.5)
+        cx, cy = centers[:, 0], centers[:, 1]
+
+        x0 = cx - a * h - b * w
+        y0 = cy + b * h - a * w
+        x1 = cx + a * h - b * w
+        y1 = cy - b * h - a * w
+        x2 = 2 * cx - x0
+        y2 = 2 * cy - y0
+        x3 = 2 * cx - x1
+        y3 = 2 * cy - y1
+        return np.stack(
+            [np.stack([x0, x1, x2, x3], axis=1), np.stack([y0, y1, y2, y3], axis=1)],
+            axis=2,
+        )
+
+    @staticmethod
+    def order_points(boxes):
+        """
+        Array version of the point ordering of get_mini_boxes.
+        boxes: (N, 4, 2) -> (N, 4, 2) in the order of top-left, top-right, bottom-right, bottom-left
+        """
+        order = np.argsort(boxes[:, :, 0], axis=1, kind="stable")
+        points = np.take_along_axis(boxes, order[:, :, None], axis=1)
+
+        swap_left = ~(points[:, 1, 1] > points[:, 0, 1])
+        swap_right = ~(points[:, 3, 1] > points[:, 2, 1])
+
+        top_left = np.where(swap_left[:, None], points[:, 1], points[:, 0])
+        bottom_left = np.where(swap_left[:, None], points[:, 0], points[:, 1])
+        top_right = np.where(swap_right[:, None], points[:, 3], points[:, 2])
+        bottom_right = np.where(swap_right[:, None], points[:, 2], points[:, 3])
+
+        return np.stack([top_left, top_right, bottom_right, bottom_left], axis=1)
+
+    def unclip_distance(self, box, area, length, unclip_ratio=7):
         # 小さい文字が見切れやすい、大きい文字のマージンが過度に大きくなる等の課題がある
         # 対応として、文字の大きさに応じて、拡大パラメータを動的に変更する
         # Note: こののルールはヒューリスティックで理論的根拠はない
-        poly = Polygon(box)
         width = box[:, 0].max() - box[:, 0].min()
         height = box[:, 1].max() - box[:, 1].min()
         box_dist = min(width, height)
         ratio = unclip_ratio / math.sqrt(box_dist)
+        return area * ratio / length
+
+    def unclip_rect(self, rect, unclip_ratio=7):
+        """
+        Closed-form unclip of a rectangle.
+        The minimum area rectangle of a rectangle offset by a distance d with round joins
+        has the same center and angle, and each side is extended by 2d.
 
-        distance = poly.area * ratio / poly.length
-        offset = pyclipper.PyclipperOffset()
-        offset.AddPath(box, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
-        expanded = np.array(offset.Execute(distance))
-        return expanded
+        rect: ((cx, cy), (w, h), angle) as returned by cv2.minAreaRect
+        """
+        center, (w, h), angle = rect
+        box = cv2.boxPoints(rect)
+        distance = self.unclip_distance(box, w * h, 2 * (w + h), unclip_ratio)
+        return center, (w + 2 * distance, h + 2 * distance), angle
 
     def get_mini_boxes(self, contour):
-        bounding_box = cv2.minAreaRect(contour)
+        return self.rect_to_box(cv2.minAreaRect(contour))
+
+    def rect_to_box(self, bounding_box):
         points = sorted(list(cv2.boxPoints(bounding_box)), key=lambda x: x[0])
 
         index_1, index_2, index_3, index_4 = 0, 1, 2, 3
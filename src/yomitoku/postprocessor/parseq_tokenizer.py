@@ -16,6 +16,7 @@
 from abc import ABC, abstractmethod
 from typing import Optional
 
+import numpy as np
 import torch
 from torch import Tensor
 from torch.nn.utils.rnn import pad_sequence
@@ -30,6 +31,8 @@ class BaseTokenizer(ABC):
     ) -> None:
         self._itos = specials_first + tuple(charset) + specials_last
         self._stoi = {s: i for i, s in enumerate(self._itos)}
+        # トークンIDから文字への変換表(バッチ単位の変換に用いる)
+        self._itos_table = np.array(self._itos, dtype=object)
 
     def __len__(self):
         return len(self._itos)
@@ -124,3 +127,62 @@ class ParseqTokenizer(BaseTokenizer):
         ids = ids[:eos_idx]
         probs = probs[: eos_idx + 1]  # but include prob. for EOS (if it exists)
         return probs, ids
+
+    def vocab(
+        self, allowed_chars: str, device: Optional[torch.device] = None
+    ) -> Tensor:
+        """Token ids of the allowed characters to restrict the recognition to.
+
+        Args:
+            allowed_chars: characters allowed in the labels
+            device: Create tensor on this device.
+
+        Returns:
+            <eos> followed by the sorted token ids of the allowed characters
+        """
+        unknown = sorted(set(allowed_chars) - set(self._stoi))
+        if unknown:
+            raise ValueError(f"Characters not in the charset: {''.join(unknown)}")
+
+        ids = sorted({self._stoi[c] for c in allowed_chars} - {self.eos_id})
+        return torch.as_tensor([self.eos_id] + ids, dtype=torch.long, device=device)
+
+    def decode_logits(
+        self, logits: Tensor, vocab: Optional[Tensor] = None
+    ) -> tuple[list[str], list[float]]:
+        """Decode a batch of logits with greedy selection on the device of the logits.
+
+        The label lengths and the sequence probabilities are computed for the whole batch at once,
+        and only the token ids and the probabilities are transferred to the host.
+        The sequence probability is the product of the probabilities of the tokens up to
+        the first <eos> (included), computed as the sum of their log-probabilities.
+
+        Args:
+            logits: output of the model before the softmax. Shape: N, L, C
+            vocab: token ids of the classes of the logits if the output is restricted by `vocab`
+
+        Returns:
+            list of string labels and their corresponding sequence probabilities
+        """
+        if len(logits) == 0:
+            return [], []
+
+        max_logits, ids = logits.max(-1)
+        log_probs = max_logits.float() - logits.float().logsumexp(-1)
+        if vocab is not None:
+            ids = vocab.to(ids.device)[ids]
+
+        # 最初の<eos>まで(<eos>自身を含む)を有効な位置とする
+        is_eos = ids == self.eos_id
+        valid = (is_eos.int().cumsum(-1) - is_eos.int()) == 0
+        scores = (log_probs * valid).sum(-1).exp()
+
+        # ラベル以降の位置は<eos>で埋め、ホスト側では<eos>以外のトークン数をラベル長とする
+        ids = ids.masked_fill(~valid, self.eos_id)
+
+        ids = ids.cpu().numpy()
+        scores = scores.cpu().tolist()
+        lengths = (ids != self.eos_id).sum(-1)
+        chars = self._itos_table[ids]
+        labels = ["".join(c[:n]) for c, n in zip(chars, lengths)]
+        return labels, scores
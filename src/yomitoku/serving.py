@@ -0,0 +1,213 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .document_analyzer import DocumentAnalyzerSchema
+from .layout_analyzer import LayoutAnalyzerSchema
+from .ocr import OCRSchema
+
+
+class MicroBatcher:
+    """
+    Collect the inputs submitted by concurrent callers into micro-batches.
+
+    A batch is dispatched when it reaches max_batch_size or when the oldest pending input
+    has waited max_wait_ms. Batches are processed one at a time on a dedicated thread,
+    and inputs submitted while a batch is running form the next batch. If a batch fails,
+    its inputs are processed one by one so that only the failing inputs raise the error.
+
+    Args:
+        func (callable): function that takes a list of inputs and returns a list of outputs in the same order
+        max_batch_size (int, optional): maximum number of inputs in a batch. Defaults to 8.
+        max_wait_ms (float, optional): maximum time in milliseconds an input waits for other inputs. Defaults to 10.
+    """
+
+    def __init__(self, func, max_batch_size=8, max_wait_ms=10):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be greater than 0.")
+
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self._pending = []
+        self._event = None
+        self._task = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+
+        # スケジューラは最初の入力を受け取った時点のイベントループで起動する
+        if self._task is None or self._task.done():
+            self._pending = []
+            self._event = asyncio.Event()
+            self._task = loop.create_task(self._schedule())
+
+        future = loop.create_future()
+        self._pending.append((item, future, loop.time()))
+        self._event.set()
+        return await future
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while len(self._pending) == 0:
+                self._event.clear()
+                await self._event.wait()
+
+            # 最も古い入力の待ち時間が上限に達するまで、後続の入力を待つ
+            deadline = self._pending[0][2] + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self._pending[: self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size :]
+            await self._process(batch)
+
+    async def _process(self, batch):
+        loop = asyncio.get_running_loop()
+        items = [item for item, _, _ in batch]
+        try:
+            outputs = await loop.run_in_executor(self.executor, self.func, items)
+        except Exception as e:
+            if len(batch) == 1:
+                _, future, _ = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+
+            # 一部の入力による失敗が他のリクエストに波及しないよう、1件ずつ処理し直す
+            for entry in batch:
+                await self._process([entry])
+            return
+
+        for (_, future, _), output in zip(batch, outputs):
+            # リクエストがキャンセルされた場合は結果を破棄する
+            if not future.done():
+                future.set_result(output)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        for _, future, _ in self._pending:
+            future.cancel()
+        self._pending = []
+
+        self.executor.shutdown(wait=True)
+
+
+class BatchingDocumentAnalyzer:
+    """
+    Serve a DocumentAnalyzer to concurrent requests with dynamic micro-batching.
+
+    Each stage (text detection, text recognition, layout parsing and table structure recognition)
+    has its own MicroBatcher, so pages of different requests are batched together at every stage,
+    and different stages run concurrently on different pages.
+
+    Args:
+        analyzer (DocumentAnalyzer): analyzer whose models are used
+        max_batch_size (int, optional): maximum number of pages in a batch of each stage. Defaults to 8.
+        max_wait_ms (float, optional): maximum time in milliseconds a page waits to form a batch. Defaults to 10.
+    """
+
+    def __init__(self, analyzer, max_batch_size=8, max_wait_ms=10):
+        self.analyzer = analyzer
+
+        kwargs = {"max_batch_size": max_batch_size, "max_wait_ms": max_wait_ms}
+        self.detector = MicroBatcher(self.run_detector, **kwargs)
+        self.recognizer = MicroBatcher(self.run_recognizer, **kwargs)
+        self.layout_parser = MicroBatcher(self.run_layout_parser, **kwargs)
+        self.table_structure_recognizer = MicroBatcher(
+            self.run_table_structure_recognizer, **kwargs
+        )
+
+    def run_detector(self, imgs):
+        return self.analyzer.ocr.detector.run_batch(imgs)
+
+    def run_recognizer(self, items):
+        imgs = [img for img, _ in items]
+        points = [points for _, points in items]
+        return self.analyzer.ocr.recognizer.run_batch(imgs, points)
+
+    def run_layout_parser(self, imgs):
+        return self.analyzer.layout.layout_parser.run_batch(imgs)
+
+    def run_table_structure_recognizer(self, items):
+        imgs = [img for img, _ in items]
+        table_boxes = [table_boxes for _, table_boxes in items]
+        return self.analyzer.layout.table_structure_recognizer.run_batch(
+            imgs, table_boxes
+        )
+
+    async def ocr(self, img):
+        det_results, _ = await self.detector.submit(img)
+        rec_results, _ = await self.recognizer.submit((img, det_results.points))
+        words = self.analyzer.ocr.aggregate(det_results, rec_results)
+        return OCRSchema(words=words)
+
+    async def layout(self, img):
+        layout = self.analyzer.layout
+        if layout is None:
+            return LayoutAnalyzerSchema(paragraphs=[], tables=[], figures=[])
+
+        layout_results, _ = await self.layout_parser.submit(img)
+
+        table_results = []
+        if layout.enable_table:
+            table_boxes = [table.box for table in layout_results.tables]
+            table_results, _ = await self.table_structure_recognizer.submit(
+                (img, table_boxes)
+            )
+
+        return LayoutAnalyzerSchema(
+            paragraphs=layout_results.paragraphs,
+            tables=table_results,
+            figures=layout_results.figures,
+        )
+
+    async def __call__(self, img):
+        """
+        Args:
+            img (np.ndarray): page image(BGR)
+
+        Returns:
+            DocumentAnalyzerSchema: analysis results of the page
+        """
+
+        analyzer = self.analyzer
+        if analyzer.use_cache:
+            key = await asyncio.to_thread(analyzer.cache_key, img)
+            results = analyzer.cache.get(key, DocumentAnalyzerSchema)
+            if results is not None:
+                return results
+
+        ocr_res, layout_res = await asyncio.gather(self.ocr(img), self.layout(img))
+        outputs = await asyncio.to_thread(analyzer.aggregate, ocr_res, layout_res, img)
+        results = DocumentAnalyzerSchema(**outputs)
+
+        if analyzer.use_cache:
+            analyzer.cache.put(key, results)
+
+        return results
+
+    async def analyze_pages(self, imgs):
+        return await asyncio.gather(*[self(img) for img in imgs])
+
+    async def close(self):
+        await asyncio.gather(
+            self.detector.close(),
+            self.recognizer.close(),
+            self.layout_parser.close(),
+            self.table_structure_recognizer.close(),
+        )
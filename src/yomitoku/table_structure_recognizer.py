@@ -1,18 +1,16 @@
 from typing import List, Union
 
-import cv2
 import os
 import onnx
 import onnxruntime
 import torch
-import torchvision.transforms as T
-from PIL import Image
 from pydantic import conlist
 
 from .constants import ROOT_DIR
 
 from .base import BaseModelCatalog, BaseModule, BaseSchema
 from .configs import TableStructureRecognizerRTDETRv2Config
+from .data.preprocess import images_to_batch, resize_image
 from .layout_parser import filter_contained_rectangles_within_category
 from .models import RTDETRv2
 from .postprocessor import RTDETRPostProcessor
@@ -133,13 +131,6 @@ class TableStructureRecognizer(BaseModule):
             num_top_queries=self._cfg.RTDETRTransformerv2.num_queries,
         )
 
-        self.transforms = T.Compose(
-            [
-                T.Resize(self._cfg.data.img_size),
-                T.ToTensor(),
-            ]
-        )
-
         self.thresh_score = self._cfg.thresh_score
 
         self.label_mapper = {
@@ -181,30 +172,38 @@ class TableStructureRecognizer(BaseModule):
         )
 
     def preprocess(self, img, boxes):
-        cv_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img_size = tuple(self._cfg.data.img_size)
 
         table_imgs = []
         for box in boxes:
             x1, y1, x2, y2 = map(int, box)
-            table_img = cv_img[y1:y2, x1:x2, :]
+            table_img = img[y1:y2, x1:x2, :]
             th, hw = table_img.shape[:2]
-            table_img = Image.fromarray(table_img)
-            img_tensor = self.transforms(table_img)[None]
             table_imgs.append(
                 {
-                    "tensor": img_tensor,
+                    "img": resize_image(table_img, img_size),
                     "size": (th, hw),
                     "offset": (x1, y1),
                 }
             )
         return table_imgs
 
+    def to_batch(self, tables):
+        return images_to_batch(
+            [data["img"] for data in tables],
+            tuple(self._cfg.data.img_size),
+            "table_structure_recognizer",
+            mean=(0, 0, 0),
+            std=(1, 1, 1),
+        )
+
     def postprocess(self, preds, data):
         h, w = data["size"]
         orig_size = torch.tensor([w, h])[None].to(self.device)
         outputs = self.postprocessor(preds, orig_size, self.thresh_score)
+        return self.build_table(outputs[0], data)
 
-        preds = outputs[0]
+    def build_table(self, preds, data):
         scores = preds["scores"]
         boxes = preds["boxes"]
         labels = preds["labels"]
@@ -262,34 +261,84 @@ class TableStructureRecognizer(BaseModule):
 
         return cells, len(row_boxes), len(col_boxes)
 
-    def __call__(self, img, table_boxes, vis=None):
-        img_tensors = self.preprocess(img, table_boxes)
-        outputs = []
-        for data in img_tensors:
-            if self.infer_onnx:
-                input = data["tensor"].numpy()
-                results = self.sess.run(None, {"input": input})
-                pred = {
-                    "pred_logits": torch.tensor(results[0]).to(self.device),
-                    "pred_boxes": torch.tensor(results[1]).to(self.device),
-                }
+    def infer(self, img_tensor):
+        if self.infer_onnx:
+            input = img_tensor.numpy()
+            results = self.sess.run(None, {"input": input})
+            pred = {
+                "pred_logits": torch.tensor(results[0]).to(self.device),
+                "pred_boxes": torch.tensor(results[1]).to(self.device),
+            }
 
-            else:
-                with torch.inference_mode():
-                    data["tensor"] = data["tensor"].to(self.device)
-                    pred = self.model(data["tensor"])
+        else:
+            with torch.inference_mode():
+                img_tensor = img_tensor.to(self.device)
+                pred = self.model(img_tensor)
 
-            table = self.postprocess(pred, data)
-            outputs.append(table)
+        return pred
 
+    def visualize_tables(self, img, tables, vis=None):
         if vis is None and self.visualize:
             vis = img.copy()
 
         if self.visualize:
-            for table in outputs:
+            for table in tables:
                 vis = table_visualizer(
                     vis,
                     table,
                 )
 
+        return vis
+
+    def __call__(self, img, table_boxes, vis=None):
+        img_tensors = self.preprocess(img, table_boxes)
+        outputs = []
+        for data in img_tensors:
+            pred = self.infer(self.to_batch([data]))
+            table = self.postprocess(pred, data)
+            outputs.append(table)
+
+        vis = self.visualize_tables(img, outputs, vis)
         return outputs, vis
+
+    def run_batch(self, imgs, table_boxes, vis=None):
+        """apply the table structure model to the tables of multiple images.
+        Table regions of all images are batched together.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+            table_boxes (list[list]): table boxes of each image
+            vis (list[np.ndarray], optional): rendering images. Defaults to None.
+
+        Returns:
+            list[tuple[list[TableStructureRecognizerSchema], np.ndarray]]: results and visualization of each image
+        """
+
+        if vis is None:
+            vis = [None] * len(imgs)
+
+        tables = []
+        for page, (img, boxes) in enumerate(zip(imgs, table_boxes)):
+            for data in self.preprocess(img, boxes):
+                data["page"] = page
+                tables.append(data)
+
+        page_tables = [[] for _ in imgs]
+        batch_size = self._cfg.data.batch_size
+        for start in range(0, len(tables), batch_size):
+            batch = tables[start : start + batch_size]
+            img_tensor = self.to_batch(batch)
+            preds = self.infer(img_tensor)
+
+            orig_size = torch.tensor(
+                [[data["size"][1], data["size"][0]] for data in batch]
+            ).to(self.device)
+            outputs = self.postprocessor(preds, orig_size, self.thresh_score)
+
+            for data, output in zip(batch, outputs):
+                page_tables[data["page"]].append(self.build_table(output, data))
+
+        return [
+            (outputs, self.visualize_tables(img, outputs, page_vis))
+            for img, outputs, page_vis in zip(imgs, page_tables, vis)
+        ]
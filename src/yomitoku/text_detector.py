@@ -1,5 +1,6 @@
 from typing import List
 
+import cv2
 import numpy as np
 import torch
 import os
@@ -8,18 +9,23 @@ from pydantic import conlist
 from .base import BaseModelCatalog, BaseModule, BaseSchema
 from .configs import TextDetectorDBNetConfig
 from .data.functions import (
-    array_to_tensor,
+    bucket_shape,
     resize_shortest_edge,
-    standardization_image,
+    tile_positions,
 )
+from .data.preprocess import images_to_batch
 from .models import DBNet
 from .postprocessor import DBnetPostProcessor
+from .utils.logger import set_logger
+from .utils.misc import merge_tiled_quads
 from .utils.visualizer import det_visualizer
 from .constants import ROOT_DIR
 
 import onnx
 import onnxruntime
 
+logger = set_logger(__name__, "INFO")
+
 
 class TextDetectorModelCatalog(BaseModelCatalog):
     def __init__(self):
@@ -108,29 +114,24 @@ class TextDetector(BaseModule):
             dynamic_axes=dynamic_axes,
         )
 
-    def preprocess(self, img):
-        img = img.copy()
-        img = img[:, :, ::-1].astype(np.float32)
-        resized = resize_shortest_edge(
-            img, self._cfg.data.shortest_size, self._cfg.data.limit_size
-        )
-        normalized = standardization_image(resized)
-        tensor = array_to_tensor(normalized)
-        return tensor
+    def resize(self, img, shortest_size=None):
+        if shortest_size is None:
+            shortest_size = self._cfg.data.shortest_size
 
-    def postprocess(self, preds, image_size):
-        return self.post_processor(preds, image_size)
+        return resize_shortest_edge(img, shortest_size, self._cfg.data.limit_size)
 
-    def __call__(self, img):
-        """apply the detection model to the input image.
+    def to_batch(self, imgs, shape):
+        # 検出モデルはBGR順の画像にRGBの平均・標準偏差を適用した入力で学習されている
+        return images_to_batch(imgs, shape, "text_detector", to_rgb=False)
 
-        Args:
-            img (np.ndarray): target image(BGR)
-        """
+    def preprocess(self, img, shortest_size=None):
+        resized = self.resize(img, shortest_size)
+        return self.to_batch([resized], resized.shape[:2])
 
-        ori_h, ori_w = img.shape[:2]
-        tensor = self.preprocess(img)
+    def postprocess(self, preds, image_size):
+        return self.post_processor(preds, image_size)
 
+    def infer(self, tensor):
         if self.infer_onnx:
             # デバイス上でテンソルを維持したまま変換
             if self.device == "cuda":
@@ -144,6 +145,10 @@ class TextDetector(BaseModule):
                 tensor = tensor.to(self.device)
                 preds = self.model(tensor)
 
+        return preds
+
+    def build_results(self, preds, img):
+        ori_h, ori_w = img.shape[:2]
         quads, scores = self.postprocess(preds, (ori_h, ori_w))
         outputs = {"points": quads, "scores": scores}
 
@@ -160,3 +165,315 @@ class TextDetector(BaseModule):
             )
 
         return results, vis
+
+    def use_tiles(self, img, scale=None):
+        tile_size = self._cfg.data.tile_size
+        if tile_size <= 0:
+            return False
+
+        if scale is None:
+            scale = self._cfg.data.tile_scale
+
+        h, w = img.shape[:2]
+        return max(h, w) * scale > self._cfg.data.limit_size
+
+    @staticmethod
+    def estimate_text_height(quads):
+        """estimate the dominant text height from the detected quads.
+
+        The height of a text line is the short side of its minimum area rectangle,
+        so horizontal and vertical lines are handled alike.
+
+        Args:
+            quads (list): detected quads
+
+        Returns:
+            float: median text height in pixels, or None if no text is detected
+        """
+
+        heights = [
+            min(cv2.minAreaRect(np.array(quad, dtype=np.float32))[1]) for quad in quads
+        ]
+        heights = [height for height in heights if height > 0]
+        if len(heights) == 0:
+            return None
+
+        return float(np.median(heights))
+
+    def adaptive_scale(self, results):
+        """decide the detection scale of the page from the results of the coarse pass.
+
+        Args:
+            results (TextDetectorSchema): results of the coarse pass
+
+        Returns:
+            float: scale of the page at which the dominant text height becomes `data.adaptive_text_height`.
+                None if no text is detected, in which case the full resolution is used.
+        """
+
+        text_height = self.estimate_text_height(results.points)
+        if text_height is None:
+            return None
+
+        return self._cfg.data.adaptive_text_height / text_height
+
+    def adaptive_size(self, img, scale):
+        # 推定した倍率をshortest_sizeに換算し、粗い推論と通常の推論の間に収める
+        if scale is None:
+            return self._cfg.data.shortest_size
+
+        size = int(min(img.shape[:2]) * scale / 32) * 32
+        return min(
+            max(size, self._cfg.data.adaptive_coarse_size),
+            self._cfg.data.shortest_size,
+        )
+
+    def refine(self, img, coarse):
+        """decide how to detect the page in the fine pass from the coarse results.
+
+        Returns:
+            tuple: ("coarse", None) to keep the coarse results, ("tiles", scale) to tile the page,
+                or ("resize", shortest_size) to run the page at a new resolution
+        """
+
+        scale = self.adaptive_scale(coarse)
+        tile_scale = self._cfg.data.tile_scale
+        if scale is not None:
+            tile_scale = min(scale, tile_scale)
+
+        if self.use_tiles(img, tile_scale):
+            return "tiles", tile_scale
+
+        size = self.adaptive_size(img, scale)
+        if size <= self._cfg.data.adaptive_coarse_size:
+            return "coarse", None
+
+        return "resize", size
+
+    def detect_adaptive(self, img):
+        """apply the detection model in two passes with an adaptive resolution.
+
+        A coarse pass at `data.adaptive_coarse_size` estimates the dominant text height
+        of the page, and the fine pass runs at the resolution where the text height becomes
+        `data.adaptive_text_height` pixels (at most `data.shortest_size`). Pages with large
+        text keep the coarse results, and pages that exceed `data.limit_size` at that
+        resolution are tiled when `data.tile_size` is set.
+
+        Args:
+            img (np.ndarray): target image(BGR)
+
+        Returns:
+            tuple[TextDetectorSchema, np.ndarray]: results and visualization of the image
+        """
+
+        tensor = self.preprocess(img, self._cfg.data.adaptive_coarse_size)
+        coarse = self.build_results(self.infer(tensor), img)
+
+        mode, value = self.refine(img, coarse[0])
+        if mode == "tiles":
+            return self.detect_tiles(img, value)
+        if mode == "resize":
+            tensor = self.preprocess(img, value)
+            return self.build_results(self.infer(tensor), img)
+        return coarse
+
+    def detect_tiles(self, img, scale=None):
+        """apply the detection model to the input image split into overlapping tiles.
+
+        The page is processed at `scale` times its original resolution without being
+        clamped to `data.limit_size`. Tiles of `data.tile_size` pixels overlapping by
+        `data.tile_overlap` pixels are inferred in batches of `data.batch_size`, so the
+        peak memory of the model depends only on the tile size. The quads of all tiles
+        are mapped back to the page and merged across the tile seams. Both
+        `data.tile_size` and `data.tile_overlap` must be multiples of 32. The heatmap
+        is not visualized for tiled pages.
+
+        Args:
+            img (np.ndarray): target image(BGR)
+            scale (float, optional): scale applied to the page before tiling. Defaults to `data.tile_scale`.
+
+        Returns:
+            tuple[TextDetectorSchema, np.ndarray]: results and visualization of the image
+        """
+
+        if scale is None:
+            scale = self._cfg.data.tile_scale
+
+        tile_size = self._cfg.data.tile_size
+        overlap = self._cfg.data.tile_overlap
+
+        # 検出モデルは入力を1/32に縮小した特徴を用いるため、タイルの大きさと間隔を32の倍数に揃える
+        if tile_size % 32 != 0 or overlap % 32 != 0:
+            raise ValueError(
+                "data.tile_size and data.tile_overlap must be multiples of 32."
+            )
+
+        ori_h, ori_w = img.shape[:2]
+        scaled = img
+        if scale != 1.0:
+            size = (max(int(ori_w * scale), 1), max(int(ori_h * scale), 1))
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            scaled = cv2.resize(img, size, interpolation=interpolation)
+
+        h, w = scaled.shape[:2]
+        tiles = [
+            (x, y)
+            for y in tile_positions(h, tile_size, overlap)
+            for x in tile_positions(w, tile_size, overlap)
+        ]
+
+        # タイルの境界付近で途切れた領域を結合候補として扱うための余白
+        margin = 2
+
+        quads, scores, seams = [], [], []
+        batch_size = self._cfg.data.batch_size
+        for start in range(0, len(tiles), batch_size):
+            positions = tiles[start : start + batch_size]
+            crops = [scaled[y : y + tile_size, x : x + tile_size] for x, y in positions]
+            batch = self.to_batch(crops, (tile_size, tile_size))
+            preds = self.infer(batch)
+
+            for k, ((x, y), crop) in enumerate(zip(positions, crops)):
+                th, tw = crop.shape[:2]
+                pred = {"binary": preds["binary"][k : k + 1, :, :th, :tw]}
+                tile_quads, tile_scores = self.postprocess(pred, (th, tw))
+
+                for quad, score in zip(tile_quads, tile_scores):
+                    xs = [px for px, _ in quad]
+                    ys = [py for _, py in quad]
+                    seam_x = (x > 0 and min(xs) <= margin) or (
+                        x + tw < w and max(xs) >= tw - 1 - margin
+                    )
+                    seam_y = (y > 0 and min(ys) <= margin) or (
+                        y + th < h and max(ys) >= th - 1 - margin
+                    )
+
+                    quads.append(
+                        [
+                            [
+                                min(round((px + x) / scale), ori_w),
+                                min(round((py + y) / scale), ori_h),
+                            ]
+                            for px, py in quad
+                        ]
+                    )
+                    scores.append(score)
+                    seams.append((seam_x, seam_y))
+
+        quads, scores = merge_tiled_quads(quads, scores, seams)
+        results = TextDetectorSchema(points=quads, scores=scores)
+
+        vis = None
+        if self.visualize:
+            if self._cfg.visualize.heatmap:
+                logger.warning(
+                    "The heatmap is not available for the pages detected in tiles."
+                )
+
+            vis = det_visualizer(
+                None,
+                img,
+                quads,
+                line_color=tuple(self._cfg.visualize.color[::-1]),
+            )
+
+        return results, vis
+
+    def __call__(self, img):
+        """apply the detection model to the input image.
+
+        Pages whose longest edge exceeds `data.limit_size` are split into tiles
+        when `data.tile_size` is set (see `detect_tiles`), and the resolution is
+        chosen per page when `data.adaptive` is set (see `detect_adaptive`).
+
+        Args:
+            img (np.ndarray): target image(BGR)
+        """
+
+        if self._cfg.data.adaptive:
+            return self.detect_adaptive(img)
+
+        if self.use_tiles(img):
+            return self.detect_tiles(img)
+
+        tensor = self.preprocess(img)
+        preds = self.infer(tensor)
+        return self.build_results(preds, img)
+
+    def run_batch(self, imgs):
+        """apply the detection model to multiple images with batched inference.
+
+        Images are grouped into a small set of canonical shapes (each edge rounded
+        up to a multiple of `data.bucket_stride`) and letterboxed (zero padded on the
+        bottom/right) to the shape of their group, so the model sees the same input
+        shapes across batches. The prediction maps are cropped back to the valid
+        region before post-processing. Pages that need tiling are processed with
+        `detect_tiles`. With `data.adaptive`, the coarse pass and the fine pass are
+        both batched.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+
+        Returns:
+            list[tuple[TextDetectorSchema, np.ndarray]]: results and visualization of each image
+        """
+
+        outputs = [None] * len(imgs)
+        if not self._cfg.data.adaptive:
+            sizes = {}
+            for i, img in enumerate(imgs):
+                if self.use_tiles(img):
+                    outputs[i] = self.detect_tiles(img)
+                else:
+                    sizes[i] = self._cfg.data.shortest_size
+
+            self.infer_buckets(imgs, sizes, outputs)
+            return outputs
+
+        coarse = [None] * len(imgs)
+        sizes = {i: self._cfg.data.adaptive_coarse_size for i in range(len(imgs))}
+        self.infer_buckets(imgs, sizes, coarse)
+
+        sizes = {}
+        for i, img in enumerate(imgs):
+            mode, value = self.refine(img, coarse[i][0])
+            if mode == "tiles":
+                outputs[i] = self.detect_tiles(img, value)
+            elif mode == "resize":
+                sizes[i] = value
+            else:
+                outputs[i] = coarse[i]
+
+        self.infer_buckets(imgs, sizes, outputs)
+        return outputs
+
+    def infer_buckets(self, imgs, sizes, outputs):
+        """run the pages in `sizes` in bucketed batches and store the results in `outputs`.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+            sizes (dict[int, int]): shortest edge length of each page to process
+            outputs (list): results and visualization of each image
+        """
+
+        resized = {i: self.resize(imgs[i], size) for i, size in sizes.items()}
+
+        buckets = {}
+        for i, img in resized.items():
+            h, w = img.shape[:2]
+            shape = bucket_shape(
+                h, w, self._cfg.data.bucket_stride, self._cfg.data.limit_size
+            )
+            buckets.setdefault(shape, []).append(i)
+
+        batch_size = self._cfg.data.batch_size
+        for shape, bucket in sorted(buckets.items()):
+            for start in range(0, len(bucket), batch_size):
+                indices = bucket[start : start + batch_size]
+                batch = self.to_batch([resized[i] for i in indices], shape)
+                preds = self.infer(batch)
+
+                for k, i in enumerate(indices):
+                    h, w = resized[i].shape[:2]
+                    pred = {"binary": preds["binary"][k : k + 1, :, :h, :w]}
+                    outputs[i] = self.build_results(pred, imgs[i])
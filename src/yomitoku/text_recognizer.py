@@ -1,14 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from typing import List
 
 import numpy as np
 import torch
 import os
 import unicodedata
-from pydantic import conlist
+from pydantic import Field, conlist
 
 from .base import BaseModelCatalog, BaseModule, BaseSchema
+from .cache import RecognitionMemo
 from .configs import TextRecognizerPARSeqConfig, TextRecognizerPARSeqSmallConfig
 from .data.dataset import ParseqDataset
+from .data.functions import (
+    extract_rois_with_grid_sample,
+    resized_text_widths,
+    validate_quads,
+)
 from .models import PARSeq
 from .postprocessor import ParseqTokenizer as Tokenizer
 from .utils.misc import load_charset
@@ -37,6 +45,8 @@ class TextRecognizerSchema(BaseSchema):
             max_length=4,
         )
     ]
+    # 各文字画像の推論方法("ar": 自己回帰、"nar": 非自己回帰と精緻化)
+    decode_paths: List[str] = Field(default_factory=list)
 
 
 class TextRecognizer(BaseModule):
@@ -66,9 +76,24 @@ class TextRecognizer(BaseModule):
         self.model.eval()
         self.model.to(self.device)
 
+        self.cascade_model = None
+        if self._cfg.cascade.model_name:
+            self.load_cascade_model(from_pretrained)
+
+        # 同じ文字画像の認識結果を呼び出し間で再利用する(ページ間、サーバーのリクエスト間を含む)
+        self.memo = None
+        if self._cfg.memo_size > 0:
+            self.memo = RecognitionMemo(self._cfg.memo_size)
+
         self.visualize = visualize
 
+        # 文字画像の切り出しを行うスレッドプールは初回の推論時に起動し、インスタンスの生存中は再利用する
+        self._crop_executor = None
+        self._crop_lock = threading.Lock()
+
         self.infer_onnx = infer_onnx
+        # ONNXモデルは入力幅が固定のため、幅ごとのバッチ分割は行わない
+        self.width_buckets = [] if infer_onnx else self.load_width_buckets()
 
         if infer_onnx:
             name = self._cfg.hf_hub_repo.split("/")[-1]
@@ -84,16 +109,220 @@ class TextRecognizer(BaseModule):
             else:
                 self.sess = onnxruntime.InferenceSession(model.SerializeToString())
 
-    def preprocess(self, img, polygons):
-        dataset = ParseqDataset(self._cfg, img, polygons)
-        dataloader = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=self._cfg.data.batch_size,
-            shuffle=False,
-            num_workers=self._cfg.data.num_workers,
+    def load_cascade_model(self, from_pretrained=True):
+        name = self._cfg.cascade.model_name
+        cfg, model = self.build_model(
+            name, self._cfg.cascade.path_cfg or None, from_pretrained
         )
 
-        return dataloader
+        # 再認識では同じ文字画像と文字集合を用いる
+        if list(cfg.data.img_size) != list(self._cfg.data.img_size):
+            raise ValueError(
+                f"Input size of the cascade model {name} {list(cfg.data.img_size)} does not match {list(self._cfg.data.img_size)}."
+            )
+        if load_charset(cfg.charset) != self.charset:
+            raise ValueError(f"Charset of the cascade model {name} does not match.")
+
+        model.tokenizer = self.tokenizer
+        model.eval()
+        model.to(self.device)
+
+        self._cascade_cfg = cfg
+        self.cascade_model = model
+
+    def load_width_buckets(self):
+        buckets = sorted(self._cfg.data.width_buckets)
+        if not buckets:
+            return []
+
+        img_w = self._cfg.data.img_size[1]
+        patch_w = self._cfg.encoder.patch_size[1]
+        if self.cascade_model is not None:
+            patch_w = int(np.lcm(patch_w, self._cascade_cfg.encoder.patch_size[1]))
+
+        for width in buckets:
+            if width <= 0 or width > img_w or width % patch_w != 0:
+                raise ValueError(
+                    f"Invalid width bucket {width}. Width buckets must be multiples of the patch width {patch_w} "
+                    f"and not larger than the input width {img_w}."
+                )
+
+        if buckets[-1] != img_w:
+            buckets.append(img_w)
+
+        return buckets
+
+    def plan_batches(self, points, use_buckets=False):
+        """
+        Split the word images into batches.
+        With `use_buckets`, the words are grouped by the width of their resized images into the
+        width buckets of the config, and each batch is recognized at the width of its bucket, so
+        short words do not pay for the padding up to the full input width.
+
+        Args:
+            points (list): quadrilaterals of the words
+            use_buckets (bool, optional): group the words by width. Defaults to False.
+
+        Returns:
+            list[tuple[np.ndarray, int]]: indices of the words and the input width of each batch
+        """
+
+        batch_size = self._cfg.data.batch_size
+        img_w = self._cfg.data.img_size[1]
+
+        if not (use_buckets and self.width_buckets) or len(points) == 0:
+            return [
+                (np.arange(start, min(start + batch_size, len(points))), img_w)
+                for start in range(0, len(points), batch_size)
+            ]
+
+        widths = resized_text_widths(points, self._cfg.data.img_size)
+        bucket_ids = np.searchsorted(self.width_buckets, widths)
+
+        batches = []
+        for k, width in enumerate(self.width_buckets):
+            indices = np.flatnonzero(bucket_ids == k)
+            for start in range(0, len(indices), batch_size):
+                batches.append((indices[start : start + batch_size], width))
+
+        return batches
+
+    @staticmethod
+    def restore_order(batches, *results):
+        """
+        Restore the order of the words from the results recognized in the order of the batches.
+        """
+
+        if not batches:
+            return results
+
+        order = np.concatenate([indices for indices, _ in batches])
+        restored = tuple([None] * len(order) for _ in results)
+        for k, i in enumerate(order):
+            for values, restored_values in zip(results, restored):
+                restored_values[i] = values[k]
+
+        return restored
+
+    def preprocess(self, img, polygons, batches=None):
+        if self._cfg.data.batched_crop:
+            validate_quads(img, polygons)
+            return self.crop_batches([img], [polygons], batches)
+
+        dataset = ParseqDataset(self._cfg, img, polygons)
+        return self.build_dataloader(dataset, batches)
+
+    def crop_batches(self, imgs, points, batches=None):
+        """
+        Iterate over the batches of word images extracted with `extract_rois_with_grid_sample`.
+        Each page is converted to a tensor on the device, and the word images of a page in a batch
+        are sampled from it at once. Word images of different pages are packed into shared batches.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+            points (list[list]): quadrilaterals of each image
+            batches (list, optional): batches of `plan_batches` over the words of all images.
+                Defaults to batches in the order of the words.
+
+        Yields:
+            torch.Tensor: (N, C, H, W) batch of word images
+        """
+
+        height = self._cfg.data.img_size[0]
+
+        page_ids = np.concatenate(
+            [np.full(len(quads), k) for k, quads in enumerate(points)] + [[]]
+        ).astype(np.int64)
+        quads = [quad for page_quads in points for quad in page_quads]
+        if batches is None:
+            batches = self.plan_batches(quads)
+
+        # 直前に変換したページはバッチをまたいで再利用する
+        page_id, page = None, None
+        for indices, width in batches:
+            pending = []
+            for k in np.unique(page_ids[indices]):
+                if k != page_id:
+                    page_id = k
+                    page = torch.as_tensor(np.ascontiguousarray(imgs[k])).to(
+                        self.device
+                    )
+                    page = page.permute(2, 0, 1)[None].float()
+
+                chunk = [quads[i] for i in indices[page_ids[indices] == k]]
+                pending.append(
+                    extract_rois_with_grid_sample(page, chunk, (height, width))
+                )
+
+            yield torch.cat(pending)
+
+    @property
+    def crop_executor(self):
+        num_workers = self._cfg.data.num_workers
+        if num_workers <= 0:
+            return None
+
+        if self._crop_executor is None:
+            with self._crop_lock:
+                if self._crop_executor is None:
+                    self._crop_executor = ThreadPoolExecutor(
+                        max_workers=num_workers,
+                        thread_name_prefix="yomitoku-crop",
+                    )
+
+        return self._crop_executor
+
+    def build_dataloader(self, dataset, batches=None):
+        """
+        Iterate over the batches of word images of the dataset.
+        The word images are extracted by the persistent crop workers of the recognizer,
+        and the next batch is extracted while the current batch is being recognized.
+
+        Args:
+            dataset (torch.utils.data.Dataset): dataset of word images
+            batches (list, optional): batches of `plan_batches` over the dataset.
+                Defaults to batches in the order of the dataset.
+
+        Yields:
+            torch.Tensor: (N, C, H, W) batch of word images
+        """
+
+        if batches is None:
+            batches = self.plan_batches(range(len(dataset)))
+
+        # 文字画像は左詰めで配置されるため、バッチの幅を超える部分はパディングのみとなる
+        def stack(images, width):
+            return torch.stack(images)[..., :width]
+
+        executor = self.crop_executor
+        if executor is None:
+            for indices, width in batches:
+                yield stack([dataset[i] for i in indices], width)
+            return
+
+        def submit(indices):
+            return [executor.submit(dataset.__getitem__, i) for i in indices]
+
+        futures = submit(batches[0][0]) if batches else []
+        try:
+            for k in range(len(batches)):
+                current = futures
+                futures = submit(batches[k + 1][0]) if k + 1 < len(batches) else []
+                width = batches[k][1]
+                yield stack([future.result() for future in current], width)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        """
+        Shut down the crop workers. They are started again when the recognizer is used next time.
+        """
+
+        with self._crop_lock:
+            if self._crop_executor is not None:
+                self._crop_executor.shutdown(wait=True)
+                self._crop_executor = None
 
     def convert_onnx(self, path_onnx):
         img_size = self._cfg.data.img_size
@@ -114,10 +343,12 @@ class TextRecognizer(BaseModule):
             dynamic_axes=dynamic_axes,
         )
 
-    def postprocess(self, p, points):
-        pred, score = self.tokenizer.decode(p)
+    def postprocess(self, logits, vocab=None):
+        pred, score = self.tokenizer.decode_logits(logits, vocab)
         pred = [unicodedata.normalize("NFKC", x) for x in pred]
+        return pred, score
 
+    def estimate_directions(self, points):
         directions = []
         for point in points:
             point = np.array(point)
@@ -127,42 +358,185 @@ class TextRecognizer(BaseModule):
             direction = "vertical" if h > w * 2 else "horizontal"
             directions.append(direction)
 
-        return pred, score, directions
+        return directions
 
-    def __call__(self, img, points, vis=None):
+    def infer(self, model, data, vocab=None):
         """
-        Apply the recognition model to the input image.
+        Apply the model to a batch of word images.
 
         Args:
-            img (np.ndarray): target image(BGR)
-            points (list): list of quadrilaterals. Each quadrilateral is represented as a list of 4 points sorted clockwise.
-            vis (np.ndarray, optional): rendering image. Defaults to None.
+            model (PARSeq): recognition model
+            data (torch.Tensor): (N, C, H, W) batch of word images
+            vocab (torch.Tensor, optional): token ids to restrict the output to. Defaults to None.
+
+        Returns:
+            tuple[torch.Tensor, list[str]]: logits and the decoding path of each word image
+        """
+
+        with torch.inference_mode():
+            data = data.to(self.device)
+            if model.cfg.hybrid.enabled:
+                logits, fallback = model.forward_hybrid(data, vocab)
+                paths = ["ar" if x else "nar" for x in fallback.tolist()]
+            else:
+                logits = model(data, vocab=vocab)
+                paths = ["ar" if model.decode_ar else "nar"] * len(data)
+
+        return logits, paths
+
+    def recognize_batch(self, data, vocab=None):
+        if self.infer_onnx:
+            input = data.cpu().numpy()
+            results = self.sess.run(["output"], {"input": input})
+            logits = torch.from_numpy(results[0])
+            # ONNXモデルの出力は全ての文字を含むため、許可された文字のみを取り出す
+            if vocab is not None:
+                logits = logits[..., vocab.cpu()]
+            paths = ["ar" if self._cfg.decode_ar else "nar"] * len(data)
+        else:
+            logits, paths = self.infer(self.model, data, vocab)
+
+        preds, scores = self.postprocess(logits, vocab)
+        return preds, scores, paths
+
+    def build_vocab(self, allowed_chars):
+        """
+        Token ids of the allowed characters, or None if all characters are allowed.
         """
 
-        dataloader = self.preprocess(img, points)
+        if allowed_chars is None:
+            return None
+        return self.tokenizer.vocab(allowed_chars, device=self.device)
+
+    def recognize(self, dataloader, allowed_chars=None):
+        """
+        Recognize the batches of word images.
+
+        Args:
+            dataloader (Iterable[torch.Tensor]): batches of word images
+            allowed_chars (str, optional): characters allowed in the results. Defaults to None (all characters).
+
+        Returns:
+            tuple[list[str], list[float], list[str]]: recognized texts, confidence scores and decoding paths
+        """
+
+        vocab = self.build_vocab(allowed_chars)
+        namespace = "" if vocab is None else "".join(sorted(set(allowed_chars)))
         preds = []
         scores = []
-        directions = []
+        paths = []
+        # 再認識を待つ文字画像とその番号(入力幅ごと)
+        pending = {}
+        # 認識結果をメモに登録する文字画像の番号とキー
+        memo_keys = {}
+        # 同じ呼び出しの中で既に現れた文字画像の番号(キーごと)と、その結果を再利用する文字画像の番号
+        first = {}
+        duplicates = {}
         for data in dataloader:
-            if self.infer_onnx:
-                input = data.numpy()
-                results = self.sess.run(["output"], {"input": input})
-                p = torch.tensor(results[0])
-            else:
-                with torch.inference_mode():
-                    data = data.to(self.device)
-                    p = self.model(data).softmax(-1)
+            if not self.infer_onnx:
+                data = data.to(self.device)
+
+            offset = len(preds)
+            batch = [None] * len(data)
+            targets = np.arange(len(data))
+            if self.memo is not None:
+                keys = self.memo.make_keys(data, namespace)
+                targets = []
+                for k, key in enumerate(keys):
+                    if key in first:
+                        # 複数ページをまとめて認識する場合も、繰り返し現れる文字画像は一度だけ認識する
+                        self.memo.count(hits=1)
+                        duplicates[offset + k] = first[key]
+                        batch[k] = (None, None, None)
+                        continue
+
+                    batch[k] = self.memo.get(key)
+                    if batch[k] is None:
+                        first[key] = offset + k
+                        targets.append(k)
+
+                targets = np.array(targets, dtype=np.int64)
+                memo_keys.update((offset + k, keys[k]) for k in targets)
+
+            if len(targets) > 0:
+                # メモにない文字画像のみを認識する
+                misses = data
+                if len(targets) < len(data):
+                    misses = data[torch.as_tensor(targets, device=data.device)]
+
+                results = zip(*self.recognize_batch(misses, vocab))
+                for k, result in zip(targets, results):
+                    batch[k] = result
+
+            for pred, score, path in batch:
+                preds.append(pred)
+                scores.append(score)
+                paths.append(path)
+
+            if self.cascade_model is None:
+                continue
+
+            low = np.array(
+                [k for k in targets if batch[k][1] < self._cfg.cascade.thresh],
+                dtype=np.int64,
+            )
+            if len(low) == 0:
+                continue
+
+            images, indices = pending.setdefault(data.shape[-1], ([], []))
+            images.append(data[torch.as_tensor(low, device=data.device)])
+            indices.extend(offset + low)
+            if len(indices) >= self._cfg.data.batch_size:
+                self.recognize_cascade(
+                    *pending.pop(data.shape[-1]),
+                    results=(preds, scores, paths),
+                    vocab=vocab,
+                )
+
+        for images, indices in pending.values():
+            self.recognize_cascade(
+                images, indices, results=(preds, scores, paths), vocab=vocab
+            )
+
+        # 再認識を含む最終的な結果を、同じ文字画像とメモに反映する
+        for i, j in duplicates.items():
+            preds[i], scores[i], paths[i] = preds[j], scores[j], paths[j]
+
+        for i, key in memo_keys.items():
+            self.memo.put(key, (preds[i], scores[i], paths[i]))
 
-            pred, score, direction = self.postprocess(p, points)
-            preds.extend(pred)
-            scores.extend(score)
-            directions.extend(direction)
+        return preds, scores, paths
 
+    def recognize_cascade(self, images, indices, results, vocab=None):
+        """
+        Recognize the word images of low confidence again with the cascade model,
+        and overwrite their results in place.
+
+        Args:
+            images (list[torch.Tensor]): word images with the same width
+            indices (list[int]): indices of the word images in the results
+            results (tuple[list, list, list]): recognized texts, confidence scores and decoding paths
+            vocab (torch.Tensor, optional): token ids to restrict the output to. Defaults to None.
+        """
+
+        batch_size = self._cfg.data.batch_size
+        images = torch.cat(images)
+        for start in range(0, len(indices), batch_size):
+            data = images[start : start + batch_size]
+            logits, path = self.infer(self.cascade_model, data, vocab)
+            pred, score = self.postprocess(logits, vocab)
+
+            for k, i in enumerate(indices[start : start + batch_size]):
+                for values, new_values in zip(results, (pred, score, path)):
+                    values[i] = new_values[k]
+
+    def build_results(self, img, points, preds, scores, vis=None, paths=None):
         outputs = {
             "contents": preds,
             "scores": scores,
             "points": points,
-            "directions": directions,
+            "directions": self.estimate_directions(points),
+            "decode_paths": paths if paths is not None else [],
         }
         results = TextRecognizerSchema(**outputs)
 
@@ -178,3 +552,77 @@ class TextRecognizer(BaseModule):
             )
 
         return results, vis
+
+    def __call__(self, img, points, vis=None, allowed_chars=None):
+        """
+        Apply the recognition model to the input image.
+
+        Args:
+            img (np.ndarray): target image(BGR)
+            points (list): list of quadrilaterals. Each quadrilateral is represented as a list of 4 points sorted clockwise.
+            vis (np.ndarray, optional): rendering image. Defaults to None.
+            allowed_chars (str, optional): characters allowed in the results (e.g. "0123456789" for digit fields).
+                The output of the model is restricted to these characters. Defaults to None (all characters).
+        """
+
+        batches = self.plan_batches(points, use_buckets=True)
+        dataloader = self.preprocess(img, points, batches)
+        preds, scores, paths = self.recognize(dataloader, allowed_chars)
+        preds, scores, paths = self.restore_order(batches, preds, scores, paths)
+        return self.build_results(img, points, preds, scores, vis, paths)
+
+    def run_batch(self, imgs, points, vis=None, allowed_chars=None):
+        """
+        Apply the recognition model to the words of multiple images.
+        Word images of all pages are packed into shared batches, so sparse pages do not run nearly empty batches.
+
+        Args:
+            imgs (list[np.ndarray]): target images(BGR)
+            points (list[list]): quadrilaterals of each image
+            vis (list[np.ndarray], optional): rendering images. Defaults to None.
+            allowed_chars (str, optional): characters allowed in the results. Defaults to None (all characters).
+
+        Returns:
+            list[tuple[TextRecognizerSchema, np.ndarray]]: results and visualization of each image
+        """
+
+        if vis is None:
+            vis = [None] * len(imgs)
+
+        batches = self.plan_batches(
+            [quad for quads in points for quad in quads], use_buckets=True
+        )
+
+        if self._cfg.data.batched_crop:
+            for img, quads in zip(imgs, points):
+                validate_quads(img, quads)
+            dataloader = self.crop_batches(imgs, points, batches)
+        else:
+            dataset = torch.utils.data.ConcatDataset(
+                [
+                    ParseqDataset(self._cfg, img, quads)
+                    for img, quads in zip(imgs, points)
+                ]
+            )
+            dataloader = self.build_dataloader(dataset, batches)
+
+        preds, scores, paths = self.recognize(dataloader, allowed_chars)
+        preds, scores, paths = self.restore_order(batches, preds, scores, paths)
+
+        outputs = []
+        offset = 0
+        for img, quads, page_vis in zip(imgs, points, vis):
+            n = len(quads)
+            outputs.append(
+                self.build_results(
+                    img,
+                    quads,
+                    preds[offset : offset + n],
+                    scores[offset : offset + n],
+                    page_vis,
+                    paths[offset : offset + n],
+                )
+            )
+            offset += n
+
+        return outputs
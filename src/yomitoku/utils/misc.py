@@ -100,3 +100,102 @@ def quad_to_xyxy(quad):
     y2 = max([y for _, y in quad])
 
     return x1, y1, x2, y2
+
+
+def merge_tiled_quads(quads, scores, seams, threshold=0.5, cell_size=128):
+    """タイルに分割して検出したテキスト領域を統合する。
+    隣接するタイルの重複領域で検出された同一の領域は一つにまとめ、
+    タイルの境界で分断された領域は結合する。
+    各領域を格子状のセルに登録し、同じセルに属する領域同士のみを比較する。
+
+    Args:
+        quads (list): ページ全体の座標系でのテキスト領域の四角形
+        scores (list): 各領域のスコア
+        seams (list): 各領域が接するタイルの境界(左右の境界に接するか, 上下の境界に接するか)
+        threshold (float, optional): 同一の領域と判定する重複率の閾値. Defaults to 0.5.
+        cell_size (int, optional): 比較対象を絞り込むためのセルの大きさ(ピクセル). Defaults to 128.
+
+    Returns:
+        tuple[list, list]: 統合後の四角形とスコア
+    """
+
+    rects = [quad_to_xyxy(quad) for quad in quads]
+    areas = [max((x2 - x1) * (y2 - y1), 1) for x1, y1, x2, y2 in rects]
+
+    def cells(rect):
+        x1, y1, x2, y2 = rect
+        return [
+            (cx, cy)
+            for cy in range(int(y1) // cell_size, int(y2) // cell_size + 1)
+            for cx in range(int(x1) // cell_size, int(x2) // cell_size + 1)
+        ]
+
+    # タイルの境界に接していない領域を優先し、面積の大きい順に処理する
+    order = sorted(range(len(quads)), key=lambda i: (any(seams[i]), -areas[i]))
+
+    kept = []
+    grid = {}
+    for i in order:
+        bx1, by1, bx2, by2 = rects[i]
+        target = None
+        duplicated = False
+
+        # 登録順に比較するため、セル内の候補を登録番号で並べる
+        candidates = sorted({k for cell in cells(rects[i]) for k in grid.get(cell, ())})
+        for k in candidates:
+            item = kept[k]
+            intersection = calc_intersection(item["rect"], rects[i])
+            if intersection is None:
+                continue
+
+            ix1, iy1, ix2, iy2 = intersection
+            x1, y1, x2, y2 = item["rect"]
+            seam_x = seams[i][0] or item["seam"][0]
+            seam_y = seams[i][1] or item["seam"][1]
+
+            # 左右の境界で分断された横長の領域、上下の境界で分断された縦長の領域は結合する
+            same_row = (iy2 - iy1) > 0.7 * max(y2 - y1, by2 - by1)
+            same_column = (ix2 - ix1) > 0.7 * max(x2 - x1, bx2 - bx1)
+            if (seam_x and same_row) or (seam_y and same_column):
+                target = k
+                break
+
+            if (ix2 - ix1) * (iy2 - iy1) / areas[i] > threshold:
+                duplicated = True
+
+        if target is not None:
+            item = kept[target]
+            x1, y1, x2, y2 = item["rect"]
+            rect = (min(x1, bx1), min(y1, by1), max(x2, bx2), max(y2, by2))
+            if rect != item["rect"]:
+                item["rect"] = rect
+                item["quad"] = None
+                for cell in cells(rect):
+                    grid.setdefault(cell, set()).add(target)
+            item["score"] = max(item["score"], scores[i])
+            # 結合後の領域は両方の領域が接する境界に接する
+            item["seam"] = (
+                item["seam"][0] or seams[i][0],
+                item["seam"][1] or seams[i][1],
+            )
+        elif not duplicated:
+            for cell in cells(rects[i]):
+                grid.setdefault(cell, set()).add(len(kept))
+            kept.append(
+                {
+                    "rect": rects[i],
+                    "quad": quads[i],
+                    "score": scores[i],
+                    "seam": seams[i],
+                }
+            )
+
+    merged_quads = []
+    for item in kept:
+        quad = item["quad"]
+        if quad is None:
+            x1, y1, x2, y2 = item["rect"]
+            quad = [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+        merged_quads.append(quad)
+
+    return merged_quads, [item["score"] for item in kept]
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from yomitoku.text_recognizer import TextRecognizer
+
+
+@pytest.fixture
+def build_recognizer(tmp_path):
+    """
+    Factory that builds a randomly initialized parseq-small recognizer on CPU.
+
+    The returned function takes the YAML text of the recognizer config.
+    """
+
+    path_cfg = tmp_path / "text_recognizer.yaml"
+
+    def build(cfg):
+        path_cfg.write_text(cfg)
+        torch.manual_seed(0)
+        return TextRecognizer(
+            model_name="parseq-small",
+            path_cfg=str(path_cfg),
+            device="cpu",
+            from_pretrained=False,
+        )
+
+    return build
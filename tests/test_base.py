@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 import pytest
@@ -5,6 +6,7 @@ import pytest
 from yomitoku.base import (
     BaseModelCatalog,
     BaseModule,
+    LazyModule,
     load_config,
     load_yaml_config,
 )
@@ -55,6 +57,41 @@ class TestModule(BaseModule):
         pass
 
 
+class TestLazyLoadModule(BaseModule):
+    model_catalog = TestModelCatalog()
+
+    def __init__(self, model_name="test", path_cfg=None):
+        super().__init__()
+        self.load_model(model_name, path_cfg, from_pretrained=False)
+
+    def __call__(self):
+        pass
+
+
+def test_lazy_module():
+    path_cfg = "tests/yaml/layout_parser.yaml"
+    holder = LazyModule(TestLazyLoadModule, path_cfg=path_cfg)
+    assert not holder.loaded
+
+    config = holder.dump_config()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        modules = list(executor.map(lambda _: holder.get(), range(4)))
+
+    assert holder.loaded
+    assert all(module is modules[0] for module in modules)
+    assert modules[0].dump_config() == config
+
+    # ONNXで推論する場合はキャッシュのキーに用いる設定が変わる
+    onnx_holder = LazyModule(TestLazyLoadModule, path_cfg=path_cfg, infer_onnx=True)
+    assert holder.cache_config() != onnx_holder.cache_config()
+
+    holder = LazyModule(TestLazyLoadModule, lazy=False)
+    assert holder.loaded
+
+    with pytest.raises(FileNotFoundError):
+        LazyModule(TestLazyLoadModule, path_cfg="tests/yaml/dummy.yaml")
+
+
 def test_base_model(tmp_path):
     module = TestModule()
     module.load_model("test", None)
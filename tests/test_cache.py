@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+
+from yomitoku.cache import DiskCache, LRUCache, RecognitionMemo, ResultCache
+from yomitoku.ocr import OCRSchema
+
+
+def test_lru_cache():
+    cache = LRUCache(max_items=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(tmp_path, max_size=25)
+    cache.put("a", "0123456789")
+    cache.put("b", "0123456789")
+    assert cache.get("a") == "0123456789"
+
+    cache.put("c", "0123456789")
+    assert cache.get("b") is None
+    assert cache.get("a") == "0123456789"
+    assert not (tmp_path / "b.json").exists()
+
+    # 再起動後も保存済みの結果を読み込める
+    cache = DiskCache(tmp_path, max_size=25)
+    assert cache.get("c") == "0123456789"
+
+
+def test_disk_cache_shared(tmp_path):
+    # 複数のプロセスが同じディレクトリを共有しても、合計のサイズが上限を超えない
+    caches = [DiskCache(tmp_path, max_size=55) for _ in range(2)]
+    for i in range(10):
+        caches[i % 2].put(str(i), "0123456789")
+
+    sizes = [path.stat().st_size for path in tmp_path.glob("*.json")]
+    assert sum(sizes) <= 55
+    assert caches[0].get("9") == "0123456789"
+    assert caches[1].get("4") is None
+
+
+def test_result_cache(tmp_path):
+    img = np.zeros((32, 32, 3), dtype=np.uint8)
+    key = ResultCache.make_key(img, "ocr", ["config"])
+
+    assert key == ResultCache.make_key(img.copy(), "ocr", ["config"])
+    assert key != ResultCache.make_key(img, "ocr", ["other_config"])
+    assert key != ResultCache.make_key(img, "layout_analyzer", ["config"])
+
+    img[0, 0, 0] = 1
+    assert key != ResultCache.make_key(img, "ocr", ["config"])
+
+    results = OCRSchema(
+        words=[
+            {
+                "points": [[0, 0], [10, 0], [10, 10], [0, 10]],
+                "content": "test",
+                "direction": "horizontal",
+                "det_score": 0.9,
+                "rec_score": 0.8,
+            }
+        ]
+    )
+
+    cache = ResultCache(cache_dir=tmp_path)
+    assert cache.get(key, OCRSchema) is None
+    cache.put(key, results)
+    assert cache.get(key, OCRSchema) == results
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    cache = ResultCache(cache_dir=tmp_path)
+    assert cache.get(key, OCRSchema) == results
+
+
+def test_recognition_memo():
+    images = torch.rand(3, 3, 32, 128) * 2 - 1
+    images[1] = images[0]
+    keys = RecognitionMemo.make_keys(images)
+
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+    assert keys[0] != RecognitionMemo.make_keys(images[:, :, :, :64])[0]
+
+    memo = RecognitionMemo(max_items=2)
+    assert memo.get(keys[0]) is None
+    memo.put(keys[0], ("test", 0.9, "ar"))
+    assert memo.get(keys[1]) == ("test", 0.9, "ar")
+    assert memo.stats() == {"hits": 1, "misses": 1, "items": 1}
+
+    memo.clear()
+    assert memo.stats() == {"hits": 0, "misses": 0, "items": 0}
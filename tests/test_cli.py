@@ -1,3 +1,5 @@
+import argparse
+import json
 import os
 from pathlib import Path
 
@@ -200,3 +202,34 @@ def test_run_dir_json(monkeypatch, tmp_path):
     filename = "test"
     out_path = os.path.join(str(tmp_path), f"{dirname}_{filename}_p1.json")
     assert os.path.exists(out_path)
+
+    with open(os.path.join(str(tmp_path), "report.json"), "r") as f:
+        report = json.load(f)
+
+    failed_files = [failure["file"] for failure in report["failed"]]
+    assert "tests/data/test.txt" in failed_files
+    assert "tests/data/test.jpg" in report["succeeded"]
+
+
+class ExitOnLoad:
+    # ワーカープロセスで復元された時点でプロセスを終了させる
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+def test_run_dir_workers_broken(tmp_path):
+    args = argparse.Namespace(workers=2, crash=ExitOnLoad())
+    files = [Path("tests/data/test.jpg"), Path("tests/data/test.txt")]
+
+    failures = main.process_directory_in_workers(args, {}, files, "json")
+    main.save_report(str(tmp_path), files, failures)
+
+    with open(os.path.join(str(tmp_path), "report.json"), "r") as f:
+        report = json.load(f)
+
+    assert report["succeeded"] == []
+    assert [failure["file"] for failure in report["failed"]] == [
+        "tests/data/test.jpg",
+        "tests/data/test.txt",
+    ]
+    assert all("BrokenProcessPool" in failure["error"] for failure in report["failed"])
@@ -1,16 +1,33 @@
+import gc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
 import numpy as np
 import pytest
+import torch
 
+from yomitoku.data import preprocess
 from yomitoku.data.functions import (
     array_to_tensor,
+    bucket_shape,
+    extract_roi_with_perspective,
+    extract_rois_with_grid_sample,
+    iter_pdf,
     load_image,
     load_pdf,
     resize_shortest_edge,
     resize_with_padding,
     rotate_text_image,
     standardization_image,
+    tile_positions,
     validate_quads,
 )
+from yomitoku.data.preprocess import (
+    get_buffer,
+    images_to_batch,
+    release_buffers,
+    resize_image,
+)
 
 
 def test_load_image():
@@ -78,6 +95,22 @@ def test_load_pdf():
         assert image.dtype == "uint8"
 
 
+def test_iter_pdf():
+    with pytest.raises(FileNotFoundError):
+        next(iter_pdf("dummy.pdf"))
+
+    with pytest.raises(ValueError):
+        next(iter_pdf("tests/data/invalid.pdf"))
+
+    pages = iter_pdf("tests/data/test.pdf")
+    images = load_pdf("tests/data/test.pdf")
+    for page, image in zip(pages, images):
+        assert page.shape == image.shape
+        assert page.dtype == "uint8"
+
+    assert next(pages, None) is None
+
+
 def test_resize_shortest_edge():
     img = np.zeros((1920, 1920, 3), dtype=np.uint8)
     resized = resize_shortest_edge(img, 1280, 1500)
@@ -112,6 +145,114 @@ def test_array_to_tensor():
     assert tensor.shape == (1, 3, 100, 50)
 
 
+def test_images_to_batch():
+    imgs = [
+        np.random.randint(0, 255, (64, 96, 3), dtype=np.uint8),
+        np.random.randint(0, 255, (32, 64, 3), dtype=np.uint8),
+    ]
+    batch = images_to_batch(imgs, (64, 96), "test")
+    assert batch.shape == (2, 3, 64, 96)
+    assert batch.dtype == torch.float32
+
+    expected = array_to_tensor(standardization_image(imgs[0].astype(np.float32)))
+    assert torch.allclose(batch[0:1], expected, atol=1e-5)
+
+    expected = array_to_tensor(standardization_image(imgs[1].astype(np.float32)))
+    assert torch.allclose(batch[1:2, :, :32, :64], expected, atol=1e-5)
+
+    # パディングは白色の背景を正規化した値で埋める
+    white = np.full((64, 96, 3), 255, dtype=np.uint8)
+    background = array_to_tensor(standardization_image(white.astype(np.float32)))[0]
+    assert torch.allclose(batch[1, :, 32:], background[:, 32:], atol=1e-5)
+    assert torch.allclose(batch[1, :, :, 64:], background[:, :, 64:], atol=1e-5)
+
+    batch = images_to_batch(imgs[:1], (64, 96), "test", (0, 0, 0), (1, 1, 1), False)
+    expected = torch.from_numpy(imgs[0]).permute(2, 0, 1) / 255
+    assert torch.allclose(batch[0], expected, atol=1e-6)
+
+
+def test_resize_image():
+    img = np.random.randint(0, 255, (100, 200, 3), dtype=np.uint8)
+    assert resize_image(img, (100, 200)) is img
+    assert resize_image(img, (50, 100)).shape == (50, 100, 3)
+    assert resize_image(img, (640, 640)).dtype == np.uint8
+
+    # 一方の辺のみを縮小する場合も面積平均で補間する
+    expected = cv2.resize(img, (100, 120), interpolation=cv2.INTER_AREA)
+    assert np.array_equal(resize_image(img, (120, 100)), expected)
+
+
+def test_buffer_limit(monkeypatch):
+    release_buffers()
+    limit = preprocess._buffer_bytes + 4 * 1000
+    monkeypatch.setattr(preprocess, "MAX_BUFFER_BYTES", limit)
+
+    def is_reused():
+        first = get_buffer("test", (1000,))
+        return get_buffer("test", (1000,)).data_ptr() == first.data_ptr()
+
+    def run_in_thread(func):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(func).result()
+
+    assert is_reused()
+
+    # 全スレッドの合計が上限を超えるバッファは保持せず、呼び出しごとに確保する
+    assert not run_in_thread(is_reused)
+
+    # 解放したバッファや終了したスレッドのバッファは上限に数えない
+    release_buffers()
+    assert run_in_thread(is_reused)
+    gc.collect()
+    assert is_reused()
+    release_buffers()
+
+
+def test_bucket_shape():
+    assert bucket_shape(1280, 1344, 128, 1600) == (1280, 1408)
+    assert bucket_shape(1280, 1568, 128, 1600) == (1280, 1600)
+    assert bucket_shape(1600, 1280, 128, 1600) == (1600, 1280)
+    assert bucket_shape(640, 800, 128, 1000) == (640, 896)
+    assert bucket_shape(640, 800, 0, 1000) == (640, 800)
+
+
+def test_tile_positions():
+    assert tile_positions(500, 1024, 128) == [0]
+    assert tile_positions(1024, 1024, 128) == [0]
+    assert tile_positions(2500, 1024, 128) == [0, 896, 1476]
+    assert tile_positions(1792, 1024, 256) == [0, 768]
+
+    with pytest.raises(ValueError):
+        tile_positions(2500, 128, 128)
+
+
+def test_extract_rois_with_grid_sample():
+    img = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    quads = [
+        [[10, 10], [110, 10], [110, 30], [10, 30]],
+        # 縦長の領域は回転して切り出す
+        [[200, 20], [220, 20], [220, 180], [200, 180]],
+        [[50, 100], [150, 95], [152, 120], [51, 124]],
+    ]
+
+    page = torch.from_numpy(img).permute(2, 0, 1)[None].float()
+    rois = extract_rois_with_grid_sample(page, quads, (32, 800))
+    assert rois.shape == (3, 3, 32, 800)
+
+    for roi, quad in zip(rois, quads):
+        expected = extract_roi_with_perspective(img, quad)
+        expected = rotate_text_image(expected, thresh_aspect=2)
+        expected = resize_with_padding(expected, (32, 800))
+        expected = torch.from_numpy(expected).permute(2, 0, 1) / 127.5 - 1
+        assert (roi - expected).abs().mean() < 0.01
+
+    assert rois[0, :, 20:].eq(-1).all()
+    assert rois[1, :, :, 160:].eq(-1).all()
+
+    assert extract_rois_with_grid_sample(page, [], (32, 800)).shape == (0, 3, 32, 800)
+
+
 def test_rotate_image():
     img = np.random.randint(0, 255, (100, 30, 3), dtype=np.uint8)
     rotated = rotate_text_image(img, thresh_aspect=2)
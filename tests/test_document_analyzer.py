@@ -1,8 +1,16 @@
+import asyncio
+import threading
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 import torch
 from omegaconf import OmegaConf
 
 from yomitoku import DocumentAnalyzer
+from yomitoku.cache import ResultCache
+from yomitoku.layout_analyzer import LayoutAnalyzerSchema
+from yomitoku.ocr import OCRSchema
 
 
 def test_initialize():
@@ -86,3 +94,117 @@ def test_invalid_config():
         DocumentAnalyzer(
             configs="invalid",
         )
+
+
+def test_stream():
+    with (
+        patch("yomitoku.document_analyzer.OCR") as ocr,
+        patch("yomitoku.document_analyzer.LayoutAnalyzer") as layout,
+    ):
+        ocr.return_value.run_batch.side_effect = lambda imgs: [
+            (OCRSchema(words=[]), None) for _ in imgs
+        ]
+        layout.return_value.run_batch.side_effect = lambda imgs: [
+            (LayoutAnalyzerSchema(paragraphs=[], tables=[], figures=[]), None)
+            for _ in imgs
+        ]
+
+        analyzer = DocumentAnalyzer(configs={}, device="cpu")
+
+        # キャッシュの参照と集約が異なるスレッドで実行されることを記録する
+        threads = {}
+        for name in ["lookup_cache", "build_page_results"]:
+
+            def record(*args, name=name, func=getattr(analyzer, name)):
+                threads.setdefault(name, set()).add(threading.current_thread())
+                return func(*args)
+
+            setattr(analyzer, name, record)
+
+        async def collect(path, batch_size):
+            return [
+                output async for output in analyzer.stream(path, batch_size=batch_size)
+            ]
+
+        for batch_size in [1, 4]:
+            outputs = asyncio.run(collect("tests/data/test.pdf", batch_size))
+            assert len(outputs) == 2
+            for img, results, ocr_vis, layout_vis in outputs:
+                assert img.shape[2] == 3
+                assert results.paragraphs == []
+
+        assert threads["lookup_cache"].isdisjoint(threads["build_page_results"])
+
+        with pytest.raises(ValueError):
+            asyncio.run(collect("tests/data/invalid.pdf", 1))
+
+        analyzer.close()
+
+
+def test_cache():
+    with (
+        patch("yomitoku.document_analyzer.OCR") as ocr,
+        patch("yomitoku.document_analyzer.LayoutAnalyzer") as layout,
+    ):
+        ocr.return_value.run_batch.side_effect = lambda imgs: [
+            (OCRSchema(words=[]), None) for _ in imgs
+        ]
+        layout.return_value.run_batch.side_effect = lambda imgs: [
+            (LayoutAnalyzerSchema(paragraphs=[], tables=[], figures=[]), None)
+            for _ in imgs
+        ]
+        ocr.return_value.cache_configs.return_value = ["config", "config"]
+        layout.return_value.cache_configs.return_value = ["config", "config"]
+        layout.return_value.enable_table = True
+
+        cache = ResultCache()
+        analyzer = DocumentAnalyzer(configs={}, device="cpu", cache=cache)
+
+        imgs = [np.zeros((32, 32, 3), dtype=np.uint8) for _ in range(2)]
+        imgs[1][0, 0, 0] = 1
+
+        outputs = asyncio.run(analyzer.analyze_pages(imgs[:1]))
+        assert len(outputs) == 1
+        assert ocr.return_value.run_batch.call_count == 1
+
+        # キャッシュされていないページのみモデルに渡される
+        outputs = asyncio.run(analyzer.analyze_pages(imgs))
+        assert len(outputs) == 2
+        assert len(ocr.return_value.run_batch.call_args.args[0]) == 1
+        assert cache.hits == 1
+
+        outputs = asyncio.run(analyzer.analyze_pages(imgs))
+        assert ocr.return_value.run_batch.call_count == 2
+        assert layout.return_value.run_batch.call_count == 2
+        assert outputs[0][0].paragraphs == []
+
+        analyzer.close()
+
+
+def test_disable_layout():
+    with (
+        patch("yomitoku.document_analyzer.OCR") as ocr,
+        patch("yomitoku.document_analyzer.LayoutAnalyzer") as layout,
+    ):
+        word = {
+            "points": [[0, 0], [10, 0], [10, 10], [0, 10]],
+            "content": "test",
+            "direction": "horizontal",
+            "det_score": 0.9,
+            "rec_score": 0.8,
+        }
+        ocr.return_value.run_batch.side_effect = lambda imgs: [
+            (OCRSchema(words=[word]), None) for _ in imgs
+        ]
+
+        analyzer = DocumentAnalyzer(configs={}, device="cpu", enable_layout=False)
+        layout.assert_not_called()
+
+        imgs = [np.zeros((32, 32, 3), dtype=np.uint8)]
+        outputs = asyncio.run(analyzer.analyze_pages(imgs))
+        results = outputs[0][0]
+        assert len(results.paragraphs) == 1
+        assert results.paragraphs[0].contents == "test"
+        assert results.tables == []
+
+        analyzer.close()
@@ -1,8 +1,13 @@
+import cv2
+import numpy as np
 import pytest
 import torch
 from omegaconf import OmegaConf
 
-from yomitoku.ocr import OCR
+from yomitoku.data.dataset import ParseqDataset
+from yomitoku.ocr import OCR, WordPrediction
+from yomitoku.text_detector import TextDetector, TextDetectorSchema
+from yomitoku.text_recognizer import TextRecognizer
 
 
 def test_ocr():
@@ -50,3 +55,341 @@ def test_ocr_invalid_config():
     config = {"test": "invalid"}
     with pytest.raises(AssertionError):
         OCR(configs=config)
+
+
+def test_recognizer_crop_workers():
+    recognizer = TextRecognizer(
+        model_name="parseq-small", device="cpu", from_pretrained=False
+    )
+    recognizer._cfg.data.batch_size = 4
+
+    img = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    quads = [
+        [[x, y], [x + 50, y], [x + 50, y + 20], [x, y + 20]]
+        for y in range(0, 150, 30)
+        for x in (0, 100)
+    ]
+    dataset = ParseqDataset(recognizer._cfg, img, quads)
+    expected = torch.stack([dataset[i] for i in range(len(dataset))])
+
+    batches = list(recognizer.build_dataloader(dataset))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert torch.equal(torch.cat(batches), expected)
+
+    # 切り出しスレッドは呼び出し間で再利用される
+    executor = recognizer.crop_executor
+    list(recognizer.preprocess(img, quads))
+    assert recognizer.crop_executor is executor
+
+    recognizer.close()
+    assert recognizer._crop_executor is None
+
+    recognizer._cfg.data.num_workers = 0
+    assert torch.equal(torch.cat(list(recognizer.build_dataloader(dataset))), expected)
+
+
+def make_batch_pages():
+    # 各ページの縮小後の大きさはバケットの大きさと一致するため、パディングされない
+    img = cv2.imread("tests/data/test.jpg")
+    return [
+        cv2.resize(img, (256, 256)),
+        cv2.resize(img, (384, 256)),
+        cv2.resize(img[100:500], (256, 256)),
+    ]
+
+
+def write_batch_config(tmp_path):
+    path_cfg = tmp_path / "text_detector.yaml"
+    path_cfg.write_text(
+        "data:\n  shortest_size: 256\n  limit_size: 384\n  bucket_stride: 128\n"
+        "post_process:\n  min_size: 4\n  box_thresh: 0.3\n"
+    )
+    return path_cfg
+
+
+def test_detector_run_batch(tmp_path):
+    path_cfg = write_batch_config(tmp_path)
+
+    torch.manual_seed(0)
+    detector = TextDetector(path_cfg=str(path_cfg), device="cpu", from_pretrained=False)
+    imgs = make_batch_pages()
+
+    outputs = detector.run_batch(imgs)
+    for img, (results, _) in zip(imgs, outputs):
+        expected, _ = detector(img)
+        assert results.points == expected.points
+        assert np.allclose(results.scores, expected.scores, atol=1e-4)
+
+
+def test_ocr_run_batch(tmp_path):
+    path_cfg = write_batch_config(tmp_path)
+    path_rec_cfg = tmp_path / "text_recognizer.yaml"
+    path_rec_cfg.write_text("max_label_length: 5\n")
+
+    torch.manual_seed(0)
+    configs = {
+        "text_detector": {"path_cfg": str(path_cfg), "from_pretrained": False},
+        "text_recognizer": {
+            "model_name": "parseq-small",
+            "path_cfg": str(path_rec_cfg),
+            "from_pretrained": False,
+        },
+    }
+    ocr = OCR(configs=configs, device="cpu")
+    imgs = make_batch_pages()
+
+    outputs = ocr.run_batch(imgs)
+    for img, (results, _) in zip(imgs, outputs):
+        expected, _ = ocr(img)
+        assert len(results.words) == len(expected.words) > 0
+        for word, expected_word in zip(results.words, expected.words):
+            assert word.points == expected_word.points
+            assert word.content == expected_word.content
+            assert word.direction == expected_word.direction
+            assert abs(word.rec_score - expected_word.rec_score) < 1e-4
+
+
+def test_recognizer_cached_decoding(build_recognizer):
+    recognizer = build_recognizer("max_label_length: 20\ndecoder:\n  depth: 2\n")
+    model = recognizer.model
+    images = torch.randn(2, 3, 32, 800)
+
+    with torch.inference_mode():
+        logits = model(images)
+        model.use_cached_decoding = lambda: False
+        expected = model(images)
+
+    assert logits.shape == expected.shape
+    assert torch.allclose(logits, expected, atol=1e-4)
+
+
+def test_recognizer_decoding_mixed_lengths(build_recognizer):
+    recognizer = build_recognizer("max_label_length: 40\n")
+    model = recognizer.model
+
+    # 位置が進むほど<eos>が出やすくなるようにして、行ごとに長さの異なるラベルを生成する
+    with torch.no_grad():
+        direction = model.head.weight[0] / model.head.weight[0].norm()
+        steps = torch.arange(model.pos_queries.shape[1])[:, None]
+        model.pos_queries[0] += 0.03 * steps * direction
+        model.text_embed.embedding.weight.mul_(60)
+
+    images = torch.randn(16, 3, 32, 800)
+    with torch.inference_mode():
+        logits = model(images)
+        model.use_cached_decoding = lambda: False
+        expected = model(images)
+
+    preds, scores = recognizer.tokenizer.decode(logits.softmax(-1))
+    expected_preds, expected_scores = recognizer.tokenizer.decode(expected.softmax(-1))
+
+    assert len({len(pred) for pred in expected_preds}) > 1
+    assert preds == expected_preds
+    assert np.allclose(scores, expected_scores, atol=1e-5)
+
+
+def test_recognizer_width_buckets(build_recognizer):
+    recognizer = build_recognizer(
+        "max_label_length: 10\ndata:\n  batch_size: 4\n  width_buckets: [256, 128]\n"
+    )
+    assert recognizer.width_buckets == [128, 256, 800]
+
+    img = np.random.randint(0, 255, (200, 900, 3), dtype=np.uint8)
+    widths = [700, 50, 200, 100, 30, 400, 120, 60, 250, 890]
+    quads = [
+        [[0, y], [w, y], [w, y + 16], [0, y + 16]]
+        for y, w in zip(range(0, 200, 20), widths)
+    ]
+
+    batches = recognizer.plan_batches(quads, use_buckets=True)
+    assert [(indices.tolist(), width) for indices, width in batches] == [
+        ([1, 3, 4, 6], 128),
+        ([7], 128),
+        ([2, 8], 256),
+        ([0, 5, 9], 800),
+    ]
+
+    # 各文字画像は分類先の幅で認識され、結果は元の順序で返される
+    dataset = ParseqDataset(recognizer._cfg, img, quads)
+    expected = []
+    with torch.inference_mode():
+        for indices, width in batches:
+            for i in indices:
+                logits = recognizer.model(dataset[i][None, ..., :width])
+                expected.append((i, recognizer.postprocess(logits)[0][0]))
+    expected = [pred for _, pred in sorted(expected)]
+
+    results, _ = recognizer(img, quads)
+    assert results.contents == expected
+
+    with pytest.raises(ValueError):
+        build_recognizer("data:\n  width_buckets: [100]\n")
+
+
+def test_recognizer_cascade(build_recognizer, tmp_path):
+    path_cascade = tmp_path / "cascade.yaml"
+    path_cascade.write_text("max_label_length: 10\nencoder:\n  depth: 2\n")
+    cfg = (
+        "max_label_length: 10\n"
+        "data:\n  batch_size: 4\n"
+        f"cascade:\n  model_name: parseq\n  path_cfg: {path_cascade}\n"
+    )
+    recognizer = build_recognizer(cfg)
+    assert recognizer.cascade_model is not None
+
+    img = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    quads = [
+        [[x, y], [x + 50, y], [x + 50, y + 20], [x, y + 20]]
+        for y in range(0, 150, 30)
+        for x in (0, 100)
+    ]
+    images = torch.cat(list(recognizer.preprocess(img, quads)))
+    with torch.inference_mode():
+        small = recognizer.postprocess(recognizer.model(images))
+        large = recognizer.postprocess(recognizer.cascade_model(images))
+
+    # スコアが閾値未満の文字画像のみ再認識の結果に置き換わる
+    thresh = float(np.median(small[1]))
+    recognizer._cfg.cascade.thresh = thresh
+    preds, scores, _ = recognizer.recognize(recognizer.preprocess(img, quads))
+
+    low = [s < thresh for s in small[1]]
+    assert 0 < sum(low) < len(quads)
+    for i, is_low in enumerate(low):
+        expected = large if is_low else small
+        assert preds[i] == expected[0][i]
+        assert np.isclose(scores[i], expected[1][i], rtol=1e-4)
+
+    path_cascade.write_text("data:\n  img_size: [32, 400]\n")
+    with pytest.raises(ValueError):
+        build_recognizer(cfg)
+
+
+def test_recognizer_hybrid_decoding(build_recognizer):
+    recognizer = build_recognizer("max_label_length: 20\nhybrid:\n  enabled: true\n")
+    model = recognizer.model
+    images = torch.randn(4, 3, 32, 800)
+
+    def decode(logits):
+        return recognizer.tokenizer.decode_logits(logits)[0]
+
+    with torch.inference_mode():
+        # 閾値を超える確率はないため、全ての行を自己回帰で推論し直す
+        model.cfg.hybrid.thresh = 2.0
+        logits, fallback = model.forward_hybrid(images)
+        assert fallback.all()
+
+        model.cfg.hybrid.enabled = False
+        assert decode(logits) == decode(model(images))
+
+        # 精緻化を行わない場合、確信度のみで判定する
+        model.refine_iters = 0
+        model.cfg.hybrid.thresh = 0.0
+        logits, fallback = model.forward_hybrid(images)
+        assert not fallback.any()
+
+        model.decode_ar = 0
+        assert decode(logits) == decode(model(images))
+
+    model.cfg.hybrid.enabled = True
+    img = np.random.randint(0, 255, (100, 200, 3), dtype=np.uint8)
+    quads = [[[0, 0], [50, 0], [50, 20], [0, 20]]]
+    results, _ = recognizer(img, quads)
+    assert results.decode_paths == ["nar"]
+
+    # 推論方法は OCR の各単語の結果にも含まれる
+    ocr = OCR(configs={"text_recognizer": {}}, device="cpu", lazy=True)
+    det_results = TextDetectorSchema(points=quads, scores=[0.9])
+    words = ocr.aggregate(det_results, results)
+    assert words[0]["decode_path"] == "nar"
+    assert WordPrediction(**words[0]).decode_path == "nar"
+
+
+def test_recognizer_memo(build_recognizer):
+    recognizer = build_recognizer(
+        "max_label_length: 10\nmemo_size: 16\ndata:\n  batch_size: 4\n"
+    )
+
+    img = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    # 左右の領域に同じ文字画像が現れる
+    img[:, 150:] = img[:, :150]
+    quads = [
+        [[x, y], [x + 50, y], [x + 50, y + 20], [x, y + 20]]
+        for y in range(0, 150, 30)
+        for x in (0, 150)
+    ]
+
+    results, _ = recognizer(img, quads[::2])
+    assert recognizer.memo.stats() == {"hits": 0, "misses": 5, "items": 5}
+
+    # 右側の文字画像はメモの結果を再利用し、残りのみを認識する
+    quads.append([[60, 0], [110, 0], [110, 20], [60, 20]])
+    memo_results, _ = recognizer(img, quads)
+    assert recognizer.memo.stats() == {"hits": 10, "misses": 6, "items": 6}
+    assert memo_results.contents[::2][:5] == results.contents
+    assert memo_results.contents[1::2] == results.contents
+
+    recognizer.memo = None
+    expected, _ = recognizer(img, quads)
+    assert memo_results.contents == expected.contents
+    assert np.allclose(memo_results.scores, expected.scores)
+
+
+def test_recognizer_memo_duplicates(build_recognizer):
+    recognizer = build_recognizer(
+        "max_label_length: 10\nmemo_size: 16\ndata:\n  batch_size: 4\n"
+    )
+
+    img = np.random.randint(0, 255, (200, 300, 3), dtype=np.uint8)
+    quads = [
+        [[x, y], [x + 50, y], [x + 50, y + 20], [x, y + 20]]
+        for y in range(0, 150, 30)
+        for x in (0, 100)
+    ]
+
+    recognize_batch = recognizer.recognize_batch
+    num_images = []
+
+    def count_images(data, vocab=None):
+        num_images.append(len(data))
+        return recognize_batch(data, vocab)
+
+    recognizer.recognize_batch = count_images
+
+    # 同じページをまとめて認識する場合も、各文字画像は一度だけ認識される
+    outputs = recognizer.run_batch([img] * 3, [quads] * 3)
+    assert sum(num_images) == len(quads)
+    assert recognizer.memo.stats() == {"hits": 20, "misses": 10, "items": 10}
+
+    recognizer.memo = None
+    expected, _ = recognizer(img, quads)
+    for results, _ in outputs:
+        assert results.contents == expected.contents
+        assert np.allclose(results.scores, expected.scores)
+
+
+def test_recognizer_allowed_chars(build_recognizer):
+    recognizer = build_recognizer("max_label_length: 10\nmemo_size: 16\n")
+    model = recognizer.model
+
+    img = np.random.randint(0, 255, (100, 200, 3), dtype=np.uint8)
+    quads = [[[0, y], [80, y], [80, y + 20], [0, y + 20]] for y in (0, 40)]
+    allowed_chars = "0123456789-"
+
+    recognizer(img, quads)
+    digits, _ = recognizer(img, quads, allowed_chars=allowed_chars)
+    assert all(set(text) <= set(allowed_chars) for text in digits.contents)
+    # 許可する文字ごとに別の結果としてメモに登録される
+    assert recognizer.memo.stats()["items"] == 4
+
+    # 許可されていない文字の出力を除いた全文字のモデルと同じ結果になる
+    vocab = recognizer.tokenizer.vocab(allowed_chars)
+    mask = torch.ones(model.head.out_features, dtype=torch.bool)
+    mask[vocab] = False
+    with torch.no_grad():
+        model.head.bias.masked_fill_(mask, -1e4)
+
+    recognizer.memo = None
+    expected, _ = recognizer(img, quads)
+    assert digits.contents == expected.contents
+    assert np.allclose(digits.scores, expected.scores, rtol=1e-4)
@@ -0,0 +1,202 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from yomitoku.postprocessor import DBnetPostProcessor, ParseqTokenizer
+from yomitoku.text_detector import TextDetector
+from yomitoku.utils.misc import merge_tiled_quads
+
+
+def make_pred():
+    pred = np.zeros((320, 480), dtype=np.float32)
+    for i in range(8):
+        for j in range(4):
+            x, y = 20 + j * 110, 20 + i * 36
+            cv2.rectangle(pred, (x, y), (x + 40 + i * 5, y + 8 + j), 0.4 + i * 0.07, -1)
+
+    box = cv2.boxPoints(((240, 300), (120, 12), 20)).astype(np.int32)
+    cv2.fillPoly(pred, [box], 0.9)
+    return {"binary": torch.from_numpy(pred)[None, None]}
+
+
+def make_document_pred(blur):
+    # 文書画像の文字部分をぼかしてテキスト領域の確率マップとする
+    img = cv2.imread("tests/data/test.jpg", cv2.IMREAD_GRAYSCALE)
+    ink = (255 - img).astype(np.float32) / 255
+    pred = np.clip(cv2.GaussianBlur(ink, (blur, blur), 0) * 3, 0, 1)
+    return {"binary": torch.from_numpy(pred)[None, None]}
+
+
+@pytest.mark.parametrize(
+    "pred", [make_pred(), make_document_pred(3), make_document_pred(7)]
+)
+@pytest.mark.parametrize("unclip_ratio", [2.0, 7.0])
+def test_vectorized_postprocessor(pred, unclip_ratio):
+    kwargs = {
+        "min_size": 2,
+        "thresh": 0.2,
+        "box_thresh": 0.5,
+        "max_candidates": 1500,
+        "unclip_ratio": unclip_ratio,
+    }
+    quads, scores = DBnetPostProcessor(**kwargs)(pred, (640, 960))
+    quads_vec, scores_vec = DBnetPostProcessor(**kwargs, vectorized=True)(
+        pred, (640, 960)
+    )
+
+    assert len(quads) > 0
+    assert quads == quads_vec
+    assert scores == scores_vec
+
+
+def test_unclip_rect():
+    postprocessor = DBnetPostProcessor(
+        min_size=2, thresh=0.2, box_thresh=0.5, max_candidates=1500, unclip_ratio=7.0
+    )
+
+    # 丸めた角で外側にオフセットした矩形を囲む最小矩形は、各辺を2dだけ伸ばした矩形になる
+    for rect, extent in [
+        (((100, 50), (80, 12), 0), (80, 12)),
+        (
+            ((200, 120), (60, 20), 30),
+            (60 * np.cos(np.pi / 6) + 10, 30 + 20 * np.cos(np.pi / 6)),
+        ),
+    ]:
+        w, h = rect[1]
+        distance = w * h * 7.0 / np.sqrt(min(extent)) / (2 * (w + h))
+
+        center, size, angle = postprocessor.unclip_rect(rect, unclip_ratio=7.0)
+        assert center == rect[0]
+        assert angle == rect[2]
+        assert np.allclose(size, (w + 2 * distance, h + 2 * distance), atol=1e-3)
+
+
+def test_compact_transfer():
+    postprocessor = DBnetPostProcessor(
+        min_size=2, thresh=0.2, box_thresh=0.5, max_candidates=1500, unclip_ratio=7.0
+    )
+    pred = make_pred()["binary"][0, 0, :, :473].clone()
+    # 閾値未満のスコアを持つ穴のある領域
+    pred[240:280, 300:400] = 0.6
+    pred[250:270, 320:380] = 0.15
+
+    bitmap, scores = postprocessor.transfer(pred, compact=False)
+    bitmap_compact, scores_compact = postprocessor.transfer(pred, compact=True)
+
+    assert bitmap.dtype == bitmap_compact.dtype == np.uint8
+    assert np.array_equal(bitmap, bitmap_compact)
+    assert np.allclose(scores, scores_compact, atol=1e-3)
+
+    quads, scores_box = postprocessor.boxes_from_bitmap(scores, bitmap, 473, 320)
+    quads_compact, scores_box_compact = postprocessor.boxes_from_bitmap(
+        scores_compact, bitmap_compact, 473, 320
+    )
+    assert quads == quads_compact
+    assert np.allclose(scores_box, scores_box_compact, atol=1e-3)
+
+
+def test_merge_tiled_quads():
+    def rect(x1, y1, x2, y2):
+        return [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+
+    quads = [
+        rect(10, 10, 100, 30),
+        # 重複領域で検出された同一の領域
+        rect(11, 10, 100, 31),
+        # 左右の境界で分断された横長の領域
+        rect(400, 50, 512, 70),
+        rect(390, 51, 600, 70),
+        # 上下の境界で分断された縦長の領域
+        rect(700, 400, 720, 512),
+        rect(700, 384, 721, 650),
+        # 境界に接していない別の領域
+        rect(90, 25, 200, 60),
+    ]
+    scores = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3]
+    seams = [
+        (False, False),
+        (False, False),
+        (True, False),
+        (True, False),
+        (False, True),
+        (False, True),
+        (False, False),
+    ]
+
+    merged, merged_scores = merge_tiled_quads(quads, scores, seams)
+    assert len(merged) == 4
+    assert rect(11, 10, 100, 31) in merged
+    assert rect(390, 50, 600, 70) in merged
+    assert rect(700, 384, 721, 650) in merged
+    assert rect(90, 25, 200, 60) in merged
+    assert sorted(merged_scores) == [0.3, 0.5, 0.7, 0.8]
+
+    # 結合後の領域は結合された領域が接する境界を引き継ぐ
+    quads = [rect(0, 0, 600, 20), rect(580, 0, 1100, 20), rect(1080, 0, 1500, 20)]
+    seams = [(False, False), (True, False), (False, True)]
+    merged, _ = merge_tiled_quads(quads, [0.9, 0.8, 0.7], seams, cell_size=64)
+    assert merged == [rect(0, 0, 1500, 20)]
+
+
+def test_estimate_text_height():
+    quads = [
+        [[0, 0], [100, 0], [100, 20], [0, 20]],
+        [[0, 40], [80, 40], [80, 64], [0, 64]],
+        # 縦書きの領域は短辺を文字の高さとする
+        [[200, 0], [222, 0], [222, 300], [200, 300]],
+    ]
+    assert TextDetector.estimate_text_height(quads) == 22
+    assert TextDetector.estimate_text_height([]) is None
+
+
+def test_decode_logits():
+    tokenizer = ParseqTokenizer("abcde")
+
+    torch.manual_seed(0)
+    logits = torch.randn(6, 10, len(tokenizer) - 2)
+    # <eos>の位置が異なる系列と、<eos>を含まない系列を作る
+    for i, pos in enumerate([0, 3, 9, 5, 2]):
+        logits[i, pos, tokenizer.eos_id] = 10
+    logits[5, :, tokenizer.eos_id] = -10
+
+    labels, scores = tokenizer.decode_logits(logits)
+    expected_labels, expected_scores = tokenizer.decode(logits.softmax(-1))
+
+    assert labels == expected_labels
+    assert np.allclose(scores, expected_scores, rtol=1e-4)
+    assert labels[0] == "" and len(labels[5]) == 10
+
+    assert tokenizer.decode_logits(logits[:0]) == ([], [])
+
+
+def test_decode_logits_with_vocab():
+    tokenizer = ParseqTokenizer("abcde")
+    vocab = tokenizer.vocab("eca")
+    assert vocab.tolist() == [tokenizer.eos_id, 1, 3, 5]
+
+    with pytest.raises(ValueError):
+        tokenizer.vocab("abz")
+
+    torch.manual_seed(0)
+    logits = torch.randn(4, 6, len(tokenizer) - 2)
+    logits[:, 4, tokenizer.eos_id] = 10
+
+    # 制限された語彙の出力は、それ以外の文字を除いた出力と同じ結果になる
+    labels, scores = tokenizer.decode_logits(logits[..., vocab], vocab)
+    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
+    mask[vocab] = False
+    expected = tokenizer.decode_logits(logits.masked_fill(mask, float("-inf")))
+
+    assert labels == expected[0]
+    assert np.allclose(scores, expected[1])
+    assert all(set(label) <= set("ace") for label in labels)
+
+
+def test_detect_tiles_size(tmp_path):
+    path_cfg = tmp_path / "cfg.yaml"
+    path_cfg.write_text("data:\n  tile_size: 1000\n  tile_overlap: 128\n")
+    detector = TextDetector(path_cfg=str(path_cfg), device="cpu", from_pretrained=False)
+
+    with pytest.raises(ValueError):
+        detector.detect_tiles(np.zeros((100, 100, 3), dtype=np.uint8))
@@ -0,0 +1,115 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+from yomitoku.layout_parser import LayoutParserSchema
+from yomitoku.serving import BatchingDocumentAnalyzer, MicroBatcher
+from yomitoku.text_detector import TextDetectorSchema
+from yomitoku.text_recognizer import TextRecognizerSchema
+
+
+def test_micro_batcher():
+    batches = []
+
+    def func(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(func, max_batch_size=4, max_wait_ms=50)
+        outputs = await asyncio.gather(*[batcher.submit(i) for i in range(10)])
+        await batcher.close()
+        return outputs
+
+    outputs = asyncio.run(run())
+    assert outputs == [i * 2 for i in range(10)]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+
+    with pytest.raises(ValueError):
+        MicroBatcher(func, max_batch_size=0)
+
+
+def test_micro_batcher_error():
+    def func(items):
+        raise RuntimeError("error")
+
+    async def run():
+        batcher = MicroBatcher(func, max_batch_size=4, max_wait_ms=1)
+        try:
+            await batcher.submit(0)
+        finally:
+            await batcher.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+
+
+def test_micro_batcher_partial_error():
+    batches = []
+
+    def func(items):
+        batches.append(items)
+        if any(item < 0 for item in items):
+            raise RuntimeError("error")
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(func, max_batch_size=4, max_wait_ms=50)
+        outputs = await asyncio.gather(
+            *[batcher.submit(i) for i in [0, 1, -1, 2]], return_exceptions=True
+        )
+        await batcher.close()
+        return outputs
+
+    outputs = asyncio.run(run())
+
+    # 失敗した入力のみがエラーとなり、他の入力は1件ずつ処理し直される
+    assert outputs[:2] == [0, 2]
+    assert isinstance(outputs[2], RuntimeError)
+    assert outputs[3] == 4
+    assert batches == [[0, 1, -1, 2], [0], [1], [-1], [2]]
+
+
+def test_batching_document_analyzer():
+    analyzer = MagicMock()
+    analyzer.use_cache = False
+    analyzer.layout.enable_table = True
+    analyzer.ocr.detector.run_batch.side_effect = lambda imgs: [
+        (TextDetectorSchema(points=[], scores=[]), None) for _ in imgs
+    ]
+    analyzer.ocr.recognizer.run_batch.side_effect = lambda imgs, points: [
+        (TextRecognizerSchema(contents=[], directions=[], scores=[], points=[]), None)
+        for _ in imgs
+    ]
+    analyzer.ocr.aggregate.return_value = []
+    analyzer.layout.layout_parser.run_batch.side_effect = lambda imgs: [
+        (LayoutParserSchema(paragraphs=[], tables=[], figures=[]), None) for _ in imgs
+    ]
+    analyzer.layout.table_structure_recognizer.run_batch.side_effect = (
+        lambda imgs, table_boxes: [([], None) for _ in imgs]
+    )
+    analyzer.aggregate.return_value = {
+        "paragraphs": [],
+        "tables": [],
+        "figures": [],
+        "words": [],
+    }
+
+    async def run():
+        batcher = BatchingDocumentAnalyzer(analyzer, max_batch_size=8, max_wait_ms=50)
+        imgs = [np.zeros((32, 32, 3), dtype=np.uint8) for _ in range(3)]
+        requests = [batcher.analyze_pages(imgs[:2]), batcher(imgs[2])]
+        outputs = await asyncio.gather(*requests)
+        await batcher.close()
+        return outputs
+
+    outputs = asyncio.run(run())
+    assert len(outputs[0]) == 2
+    assert outputs[1].paragraphs == []
+
+    # 異なるリクエストのページが1つのバッチにまとめられる
+    assert analyzer.ocr.detector.run_batch.call_count == 1
+    assert len(analyzer.ocr.detector.run_batch.call_args.args[0]) == 3
+    assert analyzer.layout.table_structure_recognizer.run_batch.call_count == 1